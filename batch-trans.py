@@ -1,4 +1,4 @@
-import os, openai, argparse, subprocess, sys, tools
+import os, openai, argparse, tools
 
 import dotenv
 dotenv.load_dotenv(dotenv.find_dotenv())
@@ -20,11 +20,11 @@ if 'is:' not in isf:
     isf = f"is:{isf}"
 
 if 'issue' in args.isf:
-    script = "srs/issue.sh"
+    trans = tools.trans_issue
 elif 'pr' in args.isf or 'pullrequest' in args.isf:
-    script = "srs/pr.sh"
+    trans = tools.trans_pullrequest
 elif 'discussion' in args.isf:
-    script = "srs/discussion.sh"
+    trans = tools.trans_discussion
 else:
     raise Exception("isf should be in [issue, pr, discussion]")
 
@@ -35,7 +35,7 @@ logs.append(f"proxy: {len(openai.api_base)}B")
 logs.append(f"key: {len(openai.api_key)}B")
 logs.append(f"isf: {isf}")
 logs.append(f"count: {args.count}")
-logs.append(f"script: {script}")
+logs.append(f"trans: {trans.__name__}")
 print(f"run with {', '.join(logs)}")
 
 if args.count <= 0 or args.count > 100:
@@ -63,5 +63,11 @@ for index, j_issue in enumerate(j_issues):
     print(f"Title: {j_issue['title']}")
     print(f"URL: {j_issue['url']}")
 
-    command = ["bash", script, "--input", j_issue["url"]]
-    subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr, text=True, check=True)
+    # Translate in the same process, so the caches, connections and rate limit budget are shared by all objects.
+    tools.github_rate_budget().begin_item(j_issue["url"])
+    trans(j_issue["url"])
+    print(f"GitHub rate limit: spent {tools.github_rate_budget().end_item()} points for {j_issue['url']}")
+
+print(f"Translation cache: {tools.trans_cache_summary()}")
+print(f"GitHub GraphQL: {tools.github_graphql_client().summary()}, ids cache: {tools.github_id_cache().summary()}")
+print(f"GitHub rate limit: {tools.github_rate_budget().summary()}")
@@ -122,10 +122,7 @@ tools.update_pullrequest(pr_id, pr_title_refined, pr_body_refined)
 print(f"PR update done.\n")
 
 print(f"===============Add label===============")
-label_id = tools.query_label_id(pr["owner"], pr["name"], tools.LABEL_REFINED_NAME)
-print(f"Query LABEL_REFINED_NAME={tools.LABEL_REFINED_NAME}, got LABEL_ID={label_id}")
-
-tools.add_label(pr_id, label_id)
-print(f"Add label ok, {label_id}({tools.LABEL_REFINED_NAME})\n")
+label_ids = tools.add_labels_by_name(pr["owner"], pr["name"], pr_id, [tools.LABEL_REFINED_NAME])
+print(f"Add label ok, {label_ids[0]}({tools.LABEL_REFINED_NAME})\n")
 
 print("\nOK\n")
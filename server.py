@@ -1,4 +1,4 @@
-import http.server, socket, json, os, openai, argparse, requests, threading, subprocess, sys
+import http.server, socket, json, os, openai, argparse, requests, requests.adapters, threading, sqlite3, time, traceback, collections, signal, sys
 import tools
 
 import dotenv
@@ -12,12 +12,31 @@ parser.add_argument("--proxy", type=str, required=False, help="OpenAI API proxy,
 parser.add_argument("--key", type=str, required=False, help="OpenAI API key, for example, xxxyyyzzz")
 parser.add_argument("--secret", type=str, required=False, help="The secret in url, for example, xxxxxx")
 parser.add_argument("--open-collective", type=str, required=False, help="Callback for the OpenCollective event.")
+parser.add_argument("--workers", type=int, default=4, required=False, help="The number of threads to handle events, for example, 4")
+parser.add_argument("--queue-size", type=int, default=100, required=False, help="The max number of events waiting for workers, for example, 100")
+parser.add_argument("--overflow", type=str, default='reject', choices=['reject', 'spill'], required=False, help="When the queue is full, reject by 503 for GitHub to retry, or spill to disk")
+parser.add_argument("--coalesce-window", type=float, default=2, required=False, help="The seconds to wait for more events of the same issue, discussion or PR, for example, 2")
+parser.add_argument("--forward-first", action='store_true', required=False, help="Forward the original event immediately, then the translation as a follow-up message of Discord")
+parser.add_argument("--forward-workers", type=int, default=2, required=False, help="The number of threads to forward messages, for example, 2")
+parser.add_argument("--forward-queue-size", type=int, default=1000, required=False, help="The max number of messages waiting to forward, the oldest is dropped when full, for example, 1000")
+parser.add_argument("--digest-window", type=float, default=0, required=False, help="The seconds to merge the forwarded events to one Discord message, 0 to disable it, for example, 60")
+parser.add_argument("--digest-by", type=str, default='thread', choices=['thread', 'repo'], required=False, help="Merge the events of the same issue, discussion or PR, or the same repository")
+parser.add_argument("--max-body", type=int, default=25 * 1024 * 1024, required=False, help="The max bytes of request body, GitHub caps payloads at 25MB, for example, 26214400")
+parser.add_argument("--read-timeout", type=float, default=10, required=False, help="The seconds to read a request or wait for next request of keep-alive, for example, 10")
+parser.add_argument("--queue-file", type=str, default='.webhook-queue.db', required=False, help="The SQLite file of the durable queue, for example, .webhook-queue.db")
 
 args = parser.parse_args()
 tools.github_token_init(args.token)
 tools.openai_init(args.key, args.proxy)
 
 IGNORE_LOGIN='dependabot'
+# The seconds to keep the handled events, to ignore the redeliveries of GitHub.
+JOBS_MAX_AGE=7 * 24 * 3600
+# The max number of events of a thread to handle in a batch.
+JOBS_MAX_BATCH=20
+# The timeout in seconds of each forward request, and the max attempts of a forward message.
+FORWARD_TIMEOUT=10
+FORWARD_MAX_ATTEMPTS=8
 
 logs = []
 logs.append(f"listen: {args.listen}")
@@ -29,6 +48,19 @@ if args.secret is not None:
     logs.append(f"secret: {len(args.secret)}B")
 if args.open_collective is not None:
     logs.append(f"open_collective: {args.open_collective}")
+logs.append(f"workers: {args.workers}")
+logs.append(f"queue_size: {args.queue_size}")
+logs.append(f"overflow: {args.overflow}")
+logs.append(f"queue_file: {args.queue_file}")
+logs.append(f"coalesce_window: {args.coalesce_window}")
+logs.append(f"forward_first: {args.forward_first}")
+logs.append(f"forward_workers: {args.forward_workers}")
+logs.append(f"forward_queue_size: {args.forward_queue_size}")
+if args.digest_window > 0:
+    logs.append(f"digest_window: {args.digest_window}")
+    logs.append(f"digest_by: {args.digest_by}")
+logs.append(f"max_body: {args.max_body}")
+logs.append(f"read_timeout: {args.read_timeout}")
 print(f"run with {', '.join(logs)}")
 
 def handle_oc_request(j_req, event, delivery, headers):
@@ -68,22 +100,146 @@ def handle_oc_request(j_req, event, delivery, headers):
         if 'content-type' in headers:
             del headers['content-type']
         headers['Content-Type'] = 'application/json'
-        res = requests.post(args.open_collective, json=j_discord, headers=headers)
-        print(f"Thread: {delivery}: Response {res.status_code} {res.reason} {len(res.text)}B {res.headers}")
+        forwarder.submit(args.open_collective, j_discord, headers, delivery)
+        print(f"Thread: {delivery}: Queued forward, {forwarder.stats()['depth']} queued")
 
     print(f"Thread: {delivery}: Done")
 
-def handle_github_request(j_req, event, delivery, headers):
+# The comment events, which are translated from the payload, to the action and the object of comment.
+COMMENT_EVENTS = {
+    'issue_comment': ('created', 'comment', 'updateIssueComment'),
+    'discussion_comment': ('created', 'comment', 'updateDiscussionComment'),
+    'pull_request_review': ('submitted', 'review', 'updatePullRequestReview'),
+    'pull_request_review_comment': ('created', 'comment', 'updatePullRequestReviewComment'),
+}
+
+# The events of new issue, discussion and PR, to the action and the object of item.
+ITEM_EVENTS = {
+    'issues': ('opened', 'issue'),
+    'discussion': ('created', 'discussion'),
+    'pull_request': ('opened', 'pull_request'),
+}
+
+# The max characters of the content of a Discord message.
+DISCORD_MAX_CONTENT=2000
+# The max characters of an event in digest, and the max events of a digest.
+DIGEST_MAX_LINE=300
+DIGEST_MAX_EVENTS=50
+
+def thread_of_github_request(j_req, event, delivery):
+    """
+    The issue, discussion or PR of the event, to serialize and coalesce the events of the same thread.
+    """
+    for name in ['issue', 'discussion', 'pull_request']:
+        if name in j_req and 'html_url' in j_req[name]:
+            return j_req[name]['html_url']
+    return delivery
+
+def handle_github_requests(jobs):
+    """
+    Handle the events of the same issue, discussion or PR, which arrive in a short window. The comments are
+    translated together so the short ones are packed in one request, and updated by one batched mutation. Each
+    event is handled on its own, so a failed event never fails the others, and return the failed deliveries.
+    """
+    jobs = [(j_req, event, delivery, headers) for (j_req, event, delivery, headers) in jobs if accept_github_request(j_req, event, delivery, headers)]
+    failed = set()
+
+    # The original events are forwarded when accepted, see Handler.do_POST, and the translation follows if it
+    # really translates the event, see forward_github_translation.
+    forwarded = set()
+    if args.forward_first:
+        for (j_req, event, delivery, headers) in jobs:
+            if content_of_github_request(j_req, event) is not None:
+                forwarded.add(delivery)
+
+    # Translate the bodies of all comments together. The body might be null, for example, an approval review.
+    # The comments of the events are skipped by the new item of the same thread, which might query them again.
+    comments = []
+    handled = set()
+    for (j_req, event, delivery, headers) in jobs:
+        if event in COMMENT_EVENTS and j_req.get('action') == COMMENT_EVENTS[event][0]:
+            comment = j_req[COMMENT_EVENTS[event][1]]
+            handled.add(comment['node_id'])
+            if comment.get('body') is not None and comment['body'].strip() != '':
+                comments.append((comment, delivery))
+    translated = {}
+    try:
+        comments_trans = tools.gpt_translate_many([comment['body'] for (comment, delivery) in comments], False)
+        translated = dict(zip([comment['node_id'] for (comment, delivery) in comments], comments_trans))
+    except Exception:
+        # Translate the comments one by one, so only the bad one fails.
+        traceback.print_exc()
+        for (comment, delivery) in comments:
+            try:
+                translated[comment['node_id']] = tools.gpt_translate(comment['body'], False)
+            except Exception:
+                traceback.print_exc()
+                failed.add(delivery)
+
+    batch = tools.GraphQLMutationBatch()
+    forwards = []
+    deliveries = {}
+    for (j_req, event, delivery, headers) in jobs:
+        if delivery in failed:
+            continue
+        try:
+            (do_forward, changed) = translate_github_request(j_req, event, delivery, batch, translated, handled)
+            if do_forward:
+                forwards.append((j_req, event, delivery, headers, changed))
+        except Exception:
+            traceback.print_exc()
+            failed.add(delivery)
+            continue
+        finally:
+            print(f"Thread: {delivery}: GitHub rate limit spent {tools.github_rate_budget().end_item()} points")
+        if event in COMMENT_EVENTS:
+            deliveries[j_req[COMMENT_EVENTS[event][1]]['node_id']] = delivery
+
+    def on_update_error(mutation):
+        print(f"Thread: {deliveries[mutation.id]}: Update comment {mutation.id} failed, {mutation.error}")
+        failed.add(deliveries[mutation.id])
+    try:
+        tools.flush_comment_updates(batch, on_update_error)
+    except Exception:
+        traceback.print_exc()
+        failed.update(deliveries.values())
+
+    for (j_req, event, delivery, headers, changed) in forwards:
+        if delivery in failed:
+            continue
+        try:
+            if delivery not in forwarded:
+                forward_github_request(j_req, event, delivery, headers)
+            elif changed:
+                forward_github_translation(j_req, event, delivery)
+        except Exception:
+            traceback.print_exc()
+            failed.add(delivery)
+
+    print(f"Thread: {', '.join([job[2] for job in jobs])}: Done, {len(failed)} failed, translation cache: {tools.trans_cache_summary()}, graphql: {tools.github_graphql_client().summary()}, rate limit: {tools.github_rate_budget().summary()}")
+    return failed
+
+def accept_github_request(j_req, event, delivery, headers):
     action = j_req['action'] if 'action' in j_req else None
     print(f"Thread: {delivery}: Got a event {event} {action}, {headers}")
 
-    if 'sender' in j_req and 'login' in j_req['sender']:
-        sender = j_req['sender']['login']
-        if IGNORE_LOGIN in sender:
-            print(f"Thread: {delivery}: Ignore sender {sender}")
-            return
+    if ignored_sender(j_req):
+        print(f"Thread: {delivery}: Ignore sender {j_req['sender']['login']}")
+        return False
+    return True
 
-    do_forward = False
+def ignored_sender(j_req):
+    return 'sender' in j_req and 'login' in j_req['sender'] and IGNORE_LOGIN in j_req['sender']['login']
+
+def translate_github_request(j_req, event, delivery, batch, translated, handled):
+    """
+    Translate the event and queue the comment update to batch, return whether to forward it, and whether it's
+    changed by the translation. The handled is the node ids of comments translated by the other events.
+    """
+    action = j_req['action'] if 'action' in j_req else None
+    tools.github_rate_budget().begin_item(f"{event}:{delivery}")
+
+    (do_forward, changed) = (False, False)
     if event == 'ping':
         print(f"Thread: {delivery}: Got a test ping")
     elif event == 'issues':
@@ -95,34 +251,10 @@ def handle_github_request(j_req, event, delivery, headers):
             number = j_req['issue']['number']
             html_url = j_req['issue']['html_url']
             print(f"Thread: {delivery}: Got an issue #{number} {html_url} {title}")
-            command = ["bash", "srs/issue.sh", "--input", html_url]
-            subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr, text=True, check=True)
-            parsed = tools.parse_issue_url(html_url)
-            trans = tools.query_issue(parsed['owner'], parsed['name'], parsed['number'])
+            trans = tools.trans_issue(html_url, tools.parse_webhook_item(j_req['issue']), handled)
             j_req['issue']['title'] = trans['title']
             j_req['issue']['body'] = trans['body']
-    elif event == 'issue_comment':
-        if action != 'created':
-            print(f"Thread: {delivery}: Ignore action {action}")
-        else:
-            do_forward = True
-            html_url = j_req['comment']['html_url']
-            issue_url = j_req['issue']['html_url']
-            node_id = j_req['comment']['node_id']
-            body = j_req['comment']['body']
-            print(f"Thread: {delivery}: Got a comment {html_url} of {issue_url} {node_id} {body}")
-            (body_trans, body_trans_by_gpt, real_translated) = tools.gpt_translate(body, False)
-            if real_translated:
-                print(f"Thread: {delivery}: Body:\n{body_trans}\n")
-                try:
-                    tools.update_issue_comment(node_id, tools.wrap_magic(body_trans))
-                    print(f"Thread: {delivery}: Updated ok")
-                except tools.GithubGraphQLException as e:
-                    if e.is_forbidden():
-                        print(f"Thread: {delivery}: Warning!!! Ignore update comment {node_id} failed, forbidden, {e.errors}")
-                    else:
-                        raise e
-            j_req['comment']['body'] = body_trans
+            changed = trans['changed']
     elif event == 'discussion':
         if action != 'created':
             print(f"Thread: {delivery}: Ignore action {action}")
@@ -132,34 +264,10 @@ def handle_github_request(j_req, event, delivery, headers):
             number = j_req['discussion']['number']
             title = j_req['discussion']['title']
             print(f"Thread: {delivery}: Got a discussion #{number} {html_url} {title}")
-            command = ["bash", "srs/discussion.sh", "--input", html_url]
-            subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr, text=True, check=True)
-            parsed = tools.parse_discussion_url(html_url)
-            trans = tools.query_discussion(parsed['owner'], parsed['name'], parsed['number'])
+            trans = tools.trans_discussion(html_url, tools.parse_webhook_item(j_req['discussion']), handled)
             j_req['discussion']['title'] = trans['title']
             j_req['discussion']['body'] = trans['body']
-    elif event == 'discussion_comment':
-        if action != 'created':
-            print(f"Thread: {delivery}: Ignore action {action}")
-        else:
-            do_forward = True
-            html_url = j_req['comment']['html_url']
-            discussion_url = j_req['discussion']['html_url']
-            node_id = j_req['comment']['node_id']
-            body = j_req['comment']['body']
-            print(f"Thread: {delivery}: Got a comment {html_url} of {discussion_url} {node_id} {body}")
-            (body_trans, body_trans_by_gpt, real_translated) = tools.gpt_translate(body, False)
-            if real_translated:
-                print(f"Thread: {delivery}: Body:\n{body_trans}\n")
-                try:
-                    tools.update_discussion_comment(node_id, tools.wrap_magic(body_trans))
-                    print(f"Thread: {delivery}: Updated ok")
-                except tools.GithubGraphQLException as e:
-                    if e.is_forbidden():
-                        print(f"Thread: {delivery}: Warning!!! Ignore update comment {node_id} failed, forbidden, {e.errors}")
-                    else:
-                        raise e
-            j_req['comment']['body'] = body_trans
+            changed = trans['changed']
     elif event == 'pull_request':
         if action != 'opened':
             print(f"Thread: {delivery}: Ignore action {action}")
@@ -169,97 +277,627 @@ def handle_github_request(j_req, event, delivery, headers):
             number = j_req['pull_request']['number']
             title = j_req['pull_request']['title']
             print(f"Thread: {delivery}: Got a pull request #{number} {html_url} {title}")
-            command = ["python", "pr-trans.py", "--input", html_url]
-            subprocess.run(command, stdout=sys.stdout, stderr=sys.stderr, text=True, check=True)
-            parsed = tools.parse_pullrequest_url(html_url)
-            trans = tools.query_pullrequest(parsed['owner'], parsed['name'], parsed['number'])
+            trans = tools.trans_pullrequest(html_url, tools.parse_webhook_item(j_req['pull_request']), handled)
             j_req['pull_request']['title'] = trans['title']
             j_req['pull_request']['body'] = trans['body']
-    elif event == 'pull_request_review':
-        if action != 'submitted':
-            print(f"Thread: {delivery}: Ignore action {action}")
-        else:
-            do_forward = True
-            html_url = j_req['review']['html_url']
-            pull_request_url = j_req['pull_request']['html_url']
-            node_id = j_req['review']['node_id']
-            body = j_req['review']['body']
-            print(f"Thread: {delivery}: Got a PR review {html_url} of {pull_request_url} {node_id} {body}")
-            (body_trans, body_trans_by_gpt, real_translated) = tools.gpt_translate(body, False)
-            if real_translated:
-                print(f"Thread: {delivery}: Body:\n{body_trans}\n")
-                try:
-                    tools.update_pullrequest_review(node_id, tools.wrap_magic(body_trans))
-                    print(f"Thread: {delivery}: Updated ok")
-                except tools.GithubGraphQLException as e:
-                    if e.is_forbidden():
-                        print(f"Thread: {delivery}: Warning!!! Ignore update PR review {node_id} failed, forbidden, {e.errors}")
-                    else:
-                        raise e
-            j_req['review']['body'] = body_trans
-    elif event == 'pull_request_review_comment':
-        if action != 'created':
+            changed = trans['changed']
+    elif event in COMMENT_EVENTS:
+        (expect_action, name, operation) = COMMENT_EVENTS[event]
+        if action != expect_action:
             print(f"Thread: {delivery}: Ignore action {action}")
         else:
             do_forward = True
-            html_url = j_req['comment']['html_url']
-            pull_request_url = j_req['pull_request']['html_url']
-            node_id = j_req['comment']['node_id']
-            body = j_req['comment']['body']
-            print(f"Thread: {delivery}: Got a PR Review comment {html_url} of {pull_request_url} {node_id} {body}")
-            (body_trans, body_trans_by_gpt, real_translated) = tools.gpt_translate(body, False)
+            html_url = j_req[name]['html_url']
+            node_id = j_req[name]['node_id']
+            body = j_req[name]['body']
+            print(f"Thread: {delivery}: Got a {event} {html_url} {node_id} {body}")
+            (body_trans, body_trans_by_gpt, real_translated) = translated.get(node_id, (body, False, False))
             if real_translated:
                 print(f"Thread: {delivery}: Body:\n{body_trans}\n")
-                try:
-                    tools.update_pullrequest_review_comment(node_id, tools.wrap_magic(body_trans))
-                    print(f"Thread: {delivery}: Updated ok")
-                except tools.GithubGraphQLException as e:
-                    if e.is_forbidden():
-                        print(f"Thread: {delivery}: Warning!!! Ignore update PR Review comment {node_id} failed, forbidden, {e.errors}")
-                    else:
-                        raise e
-            j_req['comment']['body'] = body_trans
+                batch.add(operation, node_id, tools.wrap_magic(body_trans))
+                j_req[name]['body'] = body_trans
+            changed = real_translated
     else:
         print(f"Thread: {delivery}: Ignore event {event}")
 
-    if do_forward and args.forward is not None:
-        # Without any Host set.
-        if 'Host' in headers:
-            del headers['Host']
-        # Reset the Content-Type to application/json.
-        if 'Content-Type' in headers:
-            del headers['Content-Type']
-        if 'content-type' in headers:
-            del headers['content-type']
+    return (do_forward, changed)
+
+def content_of_github_request(j_req, event):
+    """
+    The (url, title, body) of the new item or comment of the event, or None if the event is not forwarded.
+    """
+    if event in ITEM_EVENTS and j_req.get('action') == ITEM_EVENTS[event][0]:
+        item = j_req[ITEM_EVENTS[event][1]]
+        # The body is null in payload if it's empty.
+        return (item['html_url'], item['title'], item['body'] or '')
+    if event in COMMENT_EVENTS and j_req.get('action') == COMMENT_EVENTS[event][0]:
+        comment = j_req[COMMENT_EVENTS[event][1]]
+        title = None
+        for name in ['issue', 'discussion', 'pull_request']:
+            if name in j_req:
+                title = j_req[name]['title']
+        return (comment['html_url'], title, comment['body'] or '')
+    return None
+
+def discord_url():
+    """
+    The Discord webhook to post messages, that is the GitHub compatible webhook without the /github suffix, see
+    https://discord.com/developers/docs/resources/webhook, or None if the forward is not a Discord webhook.
+    """
+    if args.forward is None or not args.forward.endswith('/github'):
+        return None
+    return args.forward[:-len('/github')]
+
+def digest_key_of_github_request(j_req, event, delivery):
+    if args.digest_by == 'repo' and 'repository' in j_req:
+        return j_req['repository']['full_name']
+    return thread_of_github_request(j_req, event, delivery)
+
+def forward_github_translation(j_req, event, delivery):
+    """
+    Post the translation as a follow-up message to Discord, for the original event is already forwarded by the
+    GitHub compatible webhook.
+    """
+    if discord_url() is None:
+        print(f"Thread: {delivery}: Ignore translation for {args.forward} is not a Discord GitHub webhook")
+        return
+    (url, title, body) = content_of_github_request(j_req, event)
+    body = body.replace(f"`{tools.TRANS_MAGIC}`", '').strip() if body is not None else ''
+    if digest is not None:
+        digest.add(digest_key_of_github_request(j_req, event, delivery), f":earth_americas: Translation of [{title}](<{url}>) {body}", delivery)
+        return
+    message = f":earth_americas: Translation of [{title}](<{url}>)\n{body}"
+    if len(message) > DISCORD_MAX_CONTENT:
+        message = message[:DISCORD_MAX_CONTENT - 3] + '...'
+    forwarder.submit(discord_url(), {'content': message}, {}, delivery)
+    print(f"Thread: {delivery}: Queued follow-up translation {len(message)} chars")
+
+def forward_github_request(j_req, event, delivery, headers):
+    if args.forward is None:
+        return
+    if digest is not None:
+        (url, title, body) = content_of_github_request(j_req, event)
+        sender = j_req['sender']['login'] if 'sender' in j_req else None
+        body = body.replace(f"`{tools.TRANS_MAGIC}`", '').strip() if body is not None else ''
+        digest.add(digest_key_of_github_request(j_req, event, delivery), f"**{event}** {j_req.get('action')} by {sender}: [{title}](<{url}>) {body}", delivery)
+        return
+    # Without any Host set.
+    if 'Host' in headers:
+        del headers['Host']
+    # Reset the Content-Type to application/json.
+    if 'Content-Type' in headers:
+        del headers['Content-Type']
+    if 'content-type' in headers:
+        del headers['content-type']
+    headers['Content-Type'] = 'application/json'
+    headers['User-Agent'] = 'GitHub-Hookshot/4689486'
+    forwarder.submit(args.forward, j_req, headers, delivery)
+    print(f"Thread: {delivery}: Queued forward, {forwarder.stats()['depth']} queued")
+
+def handle_oc_requests(jobs):
+    failed = set()
+    for (j_req, event, delivery, headers) in jobs:
+        try:
+            handle_oc_request(j_req, event, delivery, headers)
+        except Exception:
+            traceback.print_exc()
+            failed.add(delivery)
+    return failed
+
+class WorkerPool:
+    """
+    A fixed number of workers fed by a durable queue in SQLite with WAL, so the threads and the requests to OpenAI
+    and GitHub are limited under a burst of events, and no event is lost or handled twice across restarts:
+        1. The event is persisted before responding 204, and the same delivery id is accepted only once.
+        2. The events are handled in order, and the running ones are handled again after a crash, at least once.
+        3. When more than queue_size events are queued, the event is rejected by 503 for GitHub to redeliver, or
+           accepted to disk anyway for the spill overflow.
+        4. The events of the same thread, like an issue, are handled one batch at a time, and the events arrive
+           in window seconds are coalesced to a batch, see take.
+    """
+    def __init__(self, handlers, workers, queue_size, overflow, filename, window):
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.window = window
+        # The threads which are being handled by workers.
+        self.running = set()
+        self.coalesced = 0
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.busy = 0
+        self.accepted = 0
+        self.duplicated = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_total = 0
+        self.wait_max = 0
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                delivery TEXT NOT NULL UNIQUE,
+                thread TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                args TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                queued_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # Upgrade the queue of old version, where each event is a thread.
+        if 'thread' not in [row[1] for row in self.db.execute("PRAGMA table_info(jobs)").fetchall()]:
+            self.db.execute("ALTER TABLE jobs ADD COLUMN thread TEXT NOT NULL DEFAULT ''")
+            self.db.execute("UPDATE jobs SET thread=delivery")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, seq)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_thread ON jobs(thread, state)")
+        # Recover the events which were running when the server crashed or restarted.
+        recovered = self.db.execute("UPDATE jobs SET state='queued' WHERE state='running'").rowcount
+        # Keep the done events for a while, to ignore the redeliveries.
+        self.db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (time.time() - JOBS_MAX_AGE,))
+        self.db.commit()
+        print(f"Open queue {filename}, recovered {recovered} running events, {self.depth()} queued")
+
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f"worker-{i}", daemon=True).start()
+
+    def depth(self):
+        return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state='queued'").fetchone()[0]
+
+    def submit(self, kind, delivery, thread, args):
+        """
+        Persist the event to handle by handlers[kind]([args, ...]) with the other events of the thread, and return
+        'accepted', or 'rejected' if the queue is full. The event of a delivery id which is already accepted is
+        ignored, and returns 'duplicated', except the failed one, which is queued again for the manual redelivery.
+        """
+        with self.cond:
+            row = self.db.execute("SELECT seq, state FROM jobs WHERE delivery=?", (delivery,)).fetchone()
+            if row is not None and row[1] != 'failed':
+                self.duplicated += 1
+                print(f"{delivery}: Ignore duplicated {kind} event")
+                return 'duplicated'
+
+            if self.overflow != 'spill' and self.depth() >= self.queue_size:
+                self.rejected += 1
+                return 'rejected'
+
+            now = time.time()
+            if row is not None:
+                print(f"{delivery}: Queue failed {kind} event again")
+                self.db.execute("UPDATE jobs SET thread=?, kind=?, args=?, state='queued', attempts=0, queued_at=?, updated_at=? WHERE seq=?", (
+                    thread, kind, json.dumps(args), now, now, row[0],
+                ))
+            else:
+                self.db.execute("INSERT INTO jobs (delivery, thread, kind, args, state, attempts, queued_at, updated_at) VALUES (?, ?, ?, ?, 'queued', 0, ?, ?)", (
+                    delivery, thread, kind, json.dumps(args), now, now,
+                ))
+            self.db.commit()
+            self.accepted += 1
+            self.cond.notify()
+            return 'accepted'
+
+    def take(self):
+        """
+        Take the events of the first thread which is not running, and whose first event is queued for window
+        seconds, to coalesce the events arrive later.
+        """
+        with self.cond:
+            while True:
+                now = time.time()
+                timeout = None
+                rows = self.db.execute("SELECT thread, MIN(queued_at) FROM jobs WHERE state='queued' GROUP BY thread ORDER BY MIN(seq)").fetchall()
+                thread = None
+                for (candidate, queued_at) in rows:
+                    if candidate in self.running:
+                        continue
+                    if now - queued_at >= self.window:
+                        thread = candidate
+                        break
+                    wait = queued_at + self.window - now
+                    timeout = wait if timeout is None else min(timeout, wait)
+                if thread is not None:
+                    break
+                self.cond.wait(timeout)
+
+            rows = self.db.execute("SELECT seq, delivery, kind, args, queued_at FROM jobs WHERE state='queued' AND thread=? ORDER BY seq LIMIT ?", (
+                thread, JOBS_MAX_BATCH,
+            )).fetchall()
+            self.db.executemany("UPDATE jobs SET state='running', attempts=attempts+1, updated_at=? WHERE seq=?", [(now, row[0]) for row in rows])
+            self.db.commit()
+            self.running.add(thread)
+            self.busy += 1
+            tools.metrics().set('jobs_in_flight', self.busy)
+            self.coalesced += len(rows) - 1
+            for row in rows:
+                self.wait_total += now - row[4]
+                self.wait_max = max(self.wait_max, now - row[4])
+            return (thread, rows[0][2], [row[0] for row in rows], [row[1] for row in rows], [json.loads(row[3]) for row in rows])
+
+    def finish(self, thread, done, failed):
+        with self.cond:
+            now = time.time()
+            self.db.executemany("UPDATE jobs SET state=?, updated_at=? WHERE seq=?",
+                [('done', now, seq) for seq in done] + [('failed', now, seq) for seq in failed])
+            self.db.commit()
+            self.running.discard(thread)
+            self.busy -= 1
+            tools.metrics().set('jobs_in_flight', self.busy)
+            self.processed += len(done)
+            self.failed += len(failed)
+            # Wakeup the workers waiting for this thread.
+            self.cond.notify_all()
+
+    def work(self):
+        while True:
+            (thread, kind, seqs, deliveries, jobs) = self.take()
+            print(f"{', '.join(deliveries)}: Handle {len(jobs)} {kind} events of {thread}, queue={self.stats()['depth']}")
+            # The handler returns the failed deliveries, or all failed if it raises.
+            try:
+                failed = self.handlers[kind](jobs)
+            except Exception:
+                traceback.print_exc()
+                failed = set(deliveries)
+            if len(failed) > 0:
+                tools.metrics().inc('errors_total', len(failed), kind='worker')
+            self.finish(thread, [seq for (seq, delivery) in zip(seqs, deliveries) if delivery not in failed],
+                [seq for (seq, delivery) in zip(seqs, deliveries) if delivery in failed])
+
+    def stats(self):
+        with self.lock:
+            handled = self.processed + self.failed
+            return {
+                'workers': self.busy,
+                'depth': self.depth(),
+                'max_depth': self.queue_size,
+                'accepted': self.accepted,
+                'coalesced': self.coalesced,
+                'duplicated': self.duplicated,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed,
+                'wait_avg': self.wait_total / handled if handled > 0 else 0,
+                'wait_max': self.wait_max,
+            }
+
+class Forwarder:
+    """
+    Forward the messages to Discord or OpenCollective in background by a pooled keep-alive session, so the workers
+    never block on a slow or rate limited target:
+        1. The message is persisted to a bounded queue in SQLite, where the oldest is dropped when more than
+           queue_size messages are queued, and the queued ones are sent again after restart.
+        2. The messages to the same url are sent one by one in order, and the url is paused by the retry_after
+           of 429, or the X-RateLimit-Reset-After when no request remains, see https://discord.com/developers/docs/topics/rate-limits
+        3. The message is retried with exponential backoff for network errors and 5xx, at most max_attempts times.
+    """
+    def __init__(self, workers, queue_size, filename, timeout, max_attempts):
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # The urls which are being sent, and the url to the time it's paused until.
+        self.sending = set()
+        self.paused = {}
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.queued = 0
+        self.delivered = 0
+        self.retried = 0
+        self.rate_limited = 0
+        self.failed = 0
+        self.dropped = 0
+        self.latency_total = 0
+        self.latency_max = 0
+
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS forwards (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                delivery TEXT NOT NULL,
+                url TEXT NOT NULL,
+                body TEXT NOT NULL,
+                headers TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                next_at REAL NOT NULL,
+                queued_at REAL NOT NULL
+            )
+        ''')
+        self.db.commit()
+        print(f"Open forward queue {filename}, {self.depth()} queued")
+
+        for i in range(workers):
+            threading.Thread(target=self.work, name=f"forwarder-{i}", daemon=True).start()
+
+    def depth(self):
+        return self.db.execute("SELECT COUNT(*) FROM forwards").fetchone()[0]
+
+    def submit(self, url, j_body, headers, delivery):
+        """
+        Persist the message to post j_body as JSON to url, which is sent later by the forwarder threads.
+        """
+        headers = dict(headers)
         headers['Content-Type'] = 'application/json'
-        headers['User-Agent'] = 'GitHub-Hookshot/4689486'
-        res = requests.post(args.forward, json=j_req, headers=headers)
-        print(f"Thread: {delivery}: Response {res.status_code} {res.reason} {len(res.text)}B {res.headers}")
+        with self.cond:
+            now = time.time()
+            self.db.execute("INSERT INTO forwards (delivery, url, body, headers, attempts, next_at, queued_at) VALUES (?, ?, ?, ?, 0, ?, ?)", (
+                delivery, url, json.dumps(j_body), json.dumps(headers), now, now,
+            ))
+            overflow = self.depth() - self.queue_size
+            if overflow > 0:
+                self.db.execute("DELETE FROM forwards WHERE seq IN (SELECT seq FROM forwards ORDER BY seq LIMIT ?)", (overflow,))
+                self.dropped += overflow
+                print(f"{delivery}: Warning!!! Drop {overflow} oldest forwards for queue is full, {self.queue_size}")
+            self.db.commit()
+            self.queued += 1
+            self.cond.notify()
 
-    print(f"Thread: {delivery}: Done")
+    def take(self):
+        """
+        Take the first message of a url which is not being sent, not paused and not waiting for retry.
+        """
+        with self.cond:
+            while True:
+                now = time.time()
+                wakeup = None
+                rows = self.db.execute("SELECT seq, delivery, url, body, headers, attempts, next_at, queued_at FROM forwards WHERE seq IN (SELECT MIN(seq) FROM forwards GROUP BY url) ORDER BY seq").fetchall()
+                for row in rows:
+                    url = row[2]
+                    if url in self.sending:
+                        continue
+                    ready_at = max(row[6], self.paused.get(url, 0))
+                    if ready_at <= now:
+                        self.sending.add(url)
+                        return row
+                    wakeup = ready_at if wakeup is None else min(wakeup, ready_at)
+                self.cond.wait(wakeup - now if wakeup is not None else None)
+
+    def finish(self, seq, url, done):
+        with self.cond:
+            if done:
+                self.db.execute("DELETE FROM forwards WHERE seq=?", (seq,))
+                self.db.commit()
+            self.sending.discard(url)
+            self.cond.notify_all()
+
+    def send(self, row):
+        """
+        Send the message, and return whether it's done, either delivered or failed permanently.
+        """
+        (seq, delivery, url, body, headers, attempts, next_at, queued_at) = row
+        starttime = time.time()
+        try:
+            res = self.session.post(url, data=body.encode('utf-8'), headers=json.loads(headers), timeout=self.timeout)
+        except requests.RequestException as e:
+            return self.retry(row, f"{e}")
+        finally:
+            tools.metrics().observe('forward_seconds', time.time() - starttime)
+
+        # Pause the url until the bucket is reset, before hitting the rate limit.
+        if res.headers.get('X-RateLimit-Remaining') == '0' and 'X-RateLimit-Reset-After' in res.headers:
+            self.pause(url, float(res.headers['X-RateLimit-Reset-After']))
 
-class Server(http.server.HTTPServer):
+        if res.status_code == 429:
+            retry_after = res.headers.get('Retry-After', 1)
+            try:
+                retry_after = res.json().get('retry_after', retry_after)
+            except ValueError:
+                pass
+            with self.lock:
+                self.rate_limited += 1
+            tools.metrics().inc('retries_total', kind='forward')
+            self.pause(url, float(retry_after))
+            print(f"{delivery}: Forward rate limited, retry after {retry_after}s, {url}")
+            return False
+        if res.status_code >= 500:
+            return self.retry(row, f"{res.status_code} {res.reason}")
+
+        latency = time.time() - queued_at
+        with self.lock:
+            if res.status_code < 300:
+                self.delivered += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+            else:
+                self.failed += 1
+                tools.metrics().inc('errors_total', kind='forward')
+        print(f"{delivery}: Forward response {res.status_code} {res.reason} {len(res.text)}B, {int(latency * 1000)}ms after queued")
+        return True
+
+    def retry(self, row, reason):
+        (seq, delivery, url, body, headers, attempts, next_at, queued_at) = row
+        attempts += 1
+        with self.cond:
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                tools.metrics().inc('errors_total', kind='forward')
+                print(f"{delivery}: Warning!!! Drop forward after {attempts} attempts, {reason}, {url}")
+                return True
+            self.retried += 1
+            tools.metrics().inc('retries_total', kind='forward')
+            self.db.execute("UPDATE forwards SET attempts=?, next_at=? WHERE seq=?", (attempts, time.time() + min(2 ** attempts, 300), seq))
+            self.db.commit()
+        print(f"{delivery}: Forward failed, retry {attempts}/{self.max_attempts}, {reason}, {url}")
+        return False
+
+    def pause(self, url, seconds):
+        with self.lock:
+            self.paused[url] = max(self.paused.get(url, 0), time.time() + seconds)
+
+    def work(self):
+        while True:
+            row = self.take()
+            done = True
+            try:
+                done = self.send(row)
+            except Exception:
+                traceback.print_exc()
+            self.finish(row[0], row[2], done)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'depth': self.depth(),
+                'max_depth': self.queue_size,
+                'queued': self.queued,
+                'delivered': self.delivered,
+                'retried': self.retried,
+                'rate_limited': self.rate_limited,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'latency_avg': self.latency_total / self.delivered if self.delivered > 0 else 0,
+                'latency_max': self.latency_max,
+            }
+
+class Digest:
+    """
+    Merge the forwarded events of the same key, like an issue or a repository, in window seconds to one Discord
+    message, to post less messages to Discord when busy. Each event is a line of at most DIGEST_MAX_LINE chars, and
+    a digest is split to several messages of at most DISCORD_MAX_CONTENT chars. The digest is posted when the
+    window is passed, DIGEST_MAX_EVENTS events are merged, or the server is shutting down, see flush.
+    """
+    def __init__(self, forwarder, url, window):
+        self.forwarder = forwarder
+        self.url = url
+        self.window = window
+        # The key to [first event time, deliveries, lines].
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.events = 0
+        self.messages = 0
+        threading.Thread(target=self.work, name="digest", daemon=True).start()
+
+    def add(self, key, line, delivery):
+        line = ' '.join(line.split())
+        if len(line) > DIGEST_MAX_LINE:
+            line = line[:DIGEST_MAX_LINE - 3] + '...'
+        with self.cond:
+            if key not in self.pending:
+                self.pending[key] = [time.time(), [], []]
+            self.pending[key][1].append(delivery)
+            self.pending[key][2].append(line)
+            self.events += 1
+            full = len(self.pending[key][2]) >= DIGEST_MAX_EVENTS
+            self.cond.notify()
+        print(f"Thread: {delivery}: Digest event of {key}")
+        if full:
+            self.flush(key)
+
+    def work(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                due = [key for (key, (first_at, deliveries, lines)) in self.pending.items() if first_at + self.window <= now]
+                if len(due) == 0:
+                    timeout = min([first_at + self.window for (first_at, deliveries, lines) in self.pending.values()], default=None)
+                    self.cond.wait(timeout - now if timeout is not None else None)
+                    continue
+            for key in due:
+                self.flush(key)
+
+    def flush(self, key=None):
+        """
+        Post the digest of the key, or all digests if key is None.
+        """
+        with self.lock:
+            keys = [key] if key is not None else list(self.pending.keys())
+            digests = [(key, self.pending.pop(key)) for key in keys if key in self.pending]
+        for (key, (first_at, deliveries, lines)) in digests:
+            messages = [f":newspaper: {len(lines)} events of <{key}>"]
+            for line in lines:
+                if len(messages[-1]) + 1 + len(line) > DISCORD_MAX_CONTENT:
+                    messages.append(line)
+                else:
+                    messages[-1] = f"{messages[-1]}\n{line}"
+            for message in messages:
+                self.forwarder.submit(self.url, {'content': message}, {}, deliveries[0])
+            with self.lock:
+                self.messages += len(messages)
+            print(f"{', '.join(deliveries)}: Queued digest of {key}, {len(lines)} events in {len(messages)} messages")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': sum([len(lines) for (first_at, deliveries, lines) in self.pending.values()]),
+                'events': self.events,
+                'messages': self.messages,
+            }
+
+class Server(http.server.ThreadingHTTPServer):
+    """
+    Handle each connection in a thread, so a slow client or a large payload never blocks the others. The events
+    are handled by the WorkerPool, so the connection threads only read, persist and acknowledge them.
+    """
+    daemon_threads = True
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         super().server_bind()
 
-class Handler(http.server.SimpleHTTPRequestHandler):
+class Handler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive for HTTP/1.1, and the timeout in seconds to read a request, for slow or idle clients.
+    protocol_version = 'HTTP/1.1'
+    timeout = args.read_timeout
+
+    def send_error(self, code, message=None, explain=None):
+        # The request body might be unread, so close the connection, or it's parsed as the next request.
+        self.close_connection = True
+        super().send_error(code, message, explain)
+
     def do_GET(self):
+        if self.path == '/api/v1/queue':
+            res_body = json.dumps({**pool.stats(), 'forwards': forwarder.stats(), 'digest': digest.stats() if digest is not None else None}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(res_body)))
+            self.end_headers()
+            self.wfile.write(res_body)
+            return
+        if self.path == '/api/v1/metrics':
+            tools.metrics().set('queue_depth', pool.stats()['depth'])
+            tools.metrics().set('forward_queue_depth', forwarder.stats()['depth'])
+            res_body = tools.metrics().render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(res_body)))
+            self.end_headers()
+            self.wfile.write(res_body)
+            return
         if self.path != '/api/v1/echo':
             return self.send_error(404, 'Not Found')
         self.send_response(200)
         self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(b'HelloWorld')))
         self.end_headers()
         self.wfile.write(b'HelloWorld')
     def do_POST(self):
+        starttime = time.time()
         if '/api/v1/hooks' not in self.path:
             return self.send_error(404, 'Not Found')
         if args.secret is not None and args.secret not in self.path:
             return self.send_error(403, 'Forbidden')
         # Read the message and convert it to a JSON object.
-        content_length = int(self.headers.get('Content-Length'))
-        req_body = self.rfile.read(content_length)
-        j_req = json.loads(req_body.decode('utf-8'))
+        content_length = self.headers.get('Content-Length')
+        if content_length is None or not content_length.isdigit():
+            return self.send_error(411, 'Length Required')
+        if int(content_length) > args.max_body:
+            return self.send_error(413, 'Payload Too Large')
+        try:
+            req_body = self.rfile.read(int(content_length))
+        except socket.timeout:
+            return self.send_error(408, 'Request Timeout')
+        try:
+            j_req = json.loads(req_body.decode('utf-8'))
+        except ValueError:
+            return self.send_error(400, 'Bad Request')
         headers = {}
         for key in self.headers.keys():
             headers[key] = self.headers.get(key)
@@ -275,29 +913,65 @@ class Handler(http.server.SimpleHTTPRequestHandler):
             if hook is not None:
                 j_req['hook']['config']['url'] = args.forward
             print(f"{delivery}: Get POST body {len(req_body)}B, event={event}, hook={hook}, headers={self.headers}")
+            tools.metrics().inc('webhook_events_total', event=event, action=j_req.get('action') or '')
+
+            # Deliver to workers.
+            thread = thread_of_github_request(j_req, event, delivery)
+            state = pool.submit('github', delivery, thread, (j_req, event, delivery, headers))
+            if state == 'rejected':
+                print(f"{delivery}: Reject {event} for queue is full, {pool.stats()}")
+                return self.send_error(503, 'Service Unavailable')
+            print(f"{delivery}: Queued {event}, queue={pool.stats()['depth']}")
 
-            # Deliver to thread.
-            print(f"{delivery}: Start a thread to handle {event}")
-            thread = threading.Thread(target=handle_github_request, args=(j_req, event, delivery, headers))
-            thread.start()
+            # Forward the original event now, without waiting for the coalesce window and translation.
+            if state == 'accepted' and args.forward_first and not ignored_sender(j_req) and content_of_github_request(j_req, event) is not None:
+                forward_github_request(j_req, event, delivery, dict(headers))
         # For OpenCollective.
         elif 'type' in j_req and 'CollectiveId' in j_req:
             event = j_req['type']
             delivery = j_req['CollectiveId']
             print(f"Got a request {self.path} {headers} {req_body}")
 
-            # Deliver to thread.
-            print(f"{delivery}: Start a thread to handle {event}")
-            thread = threading.Thread(target=handle_oc_request, args=(j_req, event, delivery, headers))
-            thread.start()
+            # Deliver to workers.
+            # The CollectiveId is not unique for each event, so never deduplicate it.
+            key = f"oc-{time.time_ns()}"
+            if pool.submit('oc', key, key, (j_req, event, delivery, headers)) == 'rejected':
+                print(f"{delivery}: Reject {event} for queue is full, {pool.stats()}")
+                return self.send_error(503, 'Service Unavailable')
+            print(f"{delivery}: Queued {event}, queue={pool.stats()['depth']}")
         else:
             return self.send_error(404, 'Not Found')
 
         self.send_response(204)
         self.end_headers()
-        print(f"{delivery}: Done")
+        tools.metrics().observe('webhook_accept_seconds', time.time() - starttime)
+        print(f"{delivery}: Done, {int((time.time() - starttime) * 1000)}ms")
+
+# Open the keep-alive connection to GitHub API, so the first webhook doesn't pay for the TLS handshake.
+tools.github_graphql_client().prewarm()
+
+forwarder = Forwarder(args.forward_workers, args.forward_queue_size, args.queue_file, FORWARD_TIMEOUT, FORWARD_MAX_ATTEMPTS)
+
+digest = None
+if args.digest_window > 0 and discord_url() is None:
+    print(f"Warning!!! Ignore digest for {args.forward} is not a Discord GitHub webhook")
+elif args.digest_window > 0:
+    digest = Digest(forwarder, discord_url(), args.digest_window)
+
+pool = WorkerPool({'github': handle_github_requests, 'oc': handle_oc_requests},
+    args.workers, args.queue_size, args.overflow, args.queue_file, args.coalesce_window)
+
+# Stop by SIGTERM of docker like Ctrl+C, to post the pending digests.
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 httpd = Server(("", args.listen), Handler)
 print(f"Serving on port {args.listen}")
-httpd.serve_forever()
+try:
+    httpd.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    if digest is not None:
+        digest.flush()
+
 
@@ -0,0 +1,74 @@
+"""
+The implementations before the table-driven detection and the streaming segmentation and masking, as the
+reference of the benchmark and the corpus test, see bench_detect.py and test_segments.py.
+"""
+import os, sys, emoji
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tools
+
+def already_english(str):
+    for c in str:
+        if len(c) != len(c.encode('utf-8')) and emoji.emoji_count(c) == 0:
+            return False
+    return True
+
+def split_segments(body):
+    lines = body.split('\n')
+    matches = []
+    current_matches = []
+    is_english = already_english(lines[0])
+    for line in lines:
+        if line == '':
+            current_matches.append('\n')
+            continue
+        if already_english(line) == is_english:
+            current_matches.append(line)
+        else:
+            matches.append('\n'.join(current_matches))
+            current_matches = [line]
+            is_english = already_english(line)
+    matches.append('\n'.join(current_matches))
+    return matches
+
+def mask_markdown(text):
+    """
+    A reference copy of tools.mask_markdown before the streaming masking, which matches the whole text instead of
+    line by line. It only proves the rewrite keeps the output, and the output itself is pinned by the golden
+    bodies of test_segments.py.
+    """
+    regions = []
+    # Never mask the text which already looks like having placeholders.
+    if '@@M' in text:
+        return (text, regions)
+
+    def placeholder(original):
+        regions.append(original)
+        return f"@@M{len(regions) - 1}@@"
+    def mask_inline(matched):
+        if tools.TRANS_MAGIC in matched.group(0):
+            return matched.group(0)
+        return placeholder(matched.group(0))
+
+    lines = text.split('\n')
+    masked = []
+    i = 0
+    while i < len(lines):
+        stripped = lines[i].strip()
+        if stripped[:3] in ['```', '~~~']:
+            # The unclosed code block lasts to the end.
+            end = i + 1
+            while end < len(lines) and not lines[end].strip().startswith(stripped[:3]):
+                end += 1
+            end = min(end, len(lines) - 1)
+            masked.append(placeholder('\n'.join(lines[i:end+1])))
+            i = end + 1
+        elif tools.MASK_LOG_PATTERN.match(lines[i]) is not None:
+            end = i
+            while end < len(lines) and tools.MASK_LOG_PATTERN.match(lines[end]) is not None:
+                end += 1
+            masked.append(placeholder('\n'.join(lines[i:end])))
+            i = end
+        else:
+            masked.append(tools.MASK_INLINE_PATTERN.sub(mask_inline, lines[i]))
+            i += 1
+    return ('\n'.join(masked), regions)
@@ -0,0 +1,37 @@
+"""
+The micro-benchmark of the language detection on 100KB bodies, the baseline vs tools. Usage:
+    python tests/bench_detect.py
+"""
+import os, sys, timeit
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tools, baseline
+
+SIZE = 100 * 1024
+
+def body(line):
+    return (line * (SIZE // len(line) + 1))[:SIZE]
+
+BODIES = {
+    'ASCII body': body('The SRS server supports RTMP, WebRTC and HLS.\n'),
+    'English with emoji': body('Thanks for the fix \U0001F600 it works ❤\n'),
+    'ASCII with CJK at end': body('The SRS server supports RTMP, WebRTC and HLS.\n')[:-2] + '中文',
+    'Mixed lines': body('The SRS server supports RTMP.\n这是一个问题。\n\n'),
+}
+
+def measure(fn, text):
+    # The best of several runs, in milliseconds.
+    return min(timeit.repeat(lambda: fn(text), number=1, repeat=5)) * 1000
+
+def main():
+    print(f"{'Body':<24}{'Function':<18}{'baseline':>12}{'tools':>12}{'speedup':>10}")
+    for (name, text) in BODIES.items():
+        for (label, old, new) in [('already_english', baseline.already_english, tools.already_english),
+                                  ('split_segments', baseline.split_segments, tools.split_segments)]:
+            if label == 'split_segments' and name != 'Mixed lines':
+                continue
+            assert old(text) == new(text), f"{label} differs for {name}"
+            (t_old, t_new) = (measure(old, text), measure(new, text))
+            print(f"{name:<24}{label:<18}{t_old:>10.2f}ms{t_new:>10.2f}ms{t_old / max(t_new, 0.001):>9.1f}x")
+
+if __name__ == '__main__':
+    main()
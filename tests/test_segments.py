@@ -0,0 +1,75 @@
+"""
+The golden corpus test of the streaming segmentation and masking, which must be the same as the baseline, see
+baseline.py, and the pinned masking of some typical bodies. Usage:
+    python -m pytest tests
+"""
+import os, sys, random
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tools, baseline
+
+LINES = [
+    '', '', ' ', 'The SRS server supports RTMP and WebRTC.', 'Thanks \U0001F600', '这是一个问题。', '中文 and English',
+    'Привет', 'ありがとう', '```', '```bash', '~~~', '    ```', 'make && ./objs/srs -c conf/srs.conf',
+    '[2023-08-01 10:00:00.123][INFO] RTMP client connected', '#0  0x00007f in main () at srs_main.cpp:10',
+    'at com.example.Main(Main.java:10)', 'File "server.py", line 10', 'Run `./configure` first 请看', 'See https://ossrs.io/lts/zh-cn/ 文档',
+    'Push to rtmp://localhost/live/livestream 推流', f"`{tools.TRANS_MAGIC}`", '@@M0@@ already masked',
+]
+
+# The bodies and the expected output of mask_markdown, which is (masked, regions).
+GOLDEN = [
+    ('这是一个问题。', ('这是一个问题。', [])),
+    ('运行 `./configure` 然后看 https://ossrs.io/lts/zh-cn/ 文档',
+        ('运行 @@M0@@ 然后看 @@M1@@ 文档', ['`./configure`', 'https://ossrs.io/lts/zh-cn/'])),
+    ('日志如下：\n```bash\nmake && ./objs/srs -c conf/srs.conf\n```\n请帮忙',
+        ('日志如下：\n@@M0@@\n请帮忙', ['```bash\nmake && ./objs/srs -c conf/srs.conf\n```'])),
+    ('崩溃了\n#0  0x00007f in main () at srs_main.cpp:10\n#1  0x00007e in run () at srs_app.cpp:20\n怎么办',
+        ('崩溃了\n@@M0@@\n怎么办', ['#0  0x00007f in main () at srs_main.cpp:10\n#1  0x00007e in run () at srs_app.cpp:20'])),
+    ('[2023-08-01 10:00:00.123][INFO] RTMP client connected\n推流 rtmp://localhost/live/livestream 失败',
+        ('@@M0@@\n推流 @@M1@@ 失败', ['[2023-08-01 10:00:00.123][INFO] RTMP client connected', 'rtmp://localhost/live/livestream'])),
+    ('```\nunclosed code 中文', ('@@M0@@', ['```\nunclosed code 中文'])),
+    ('@@M0@@ already masked 中文', ('@@M0@@ already masked 中文', [])),
+]
+
+def corpus():
+    rand = random.Random(2023)
+    bodies = ['', '\n', '\n\n', 'a', '中', '\nThe first line is empty', 'The last line is empty\n', '```\nunclosed code 中文']
+    for i in range(5000):
+        bodies.append('\n'.join([rand.choice(LINES) for j in range(rand.randint(1, 30))]))
+    return bodies
+
+def test_split_segments():
+    for body in corpus():
+        assert tools.split_segments(body) == baseline.split_segments(body), repr(body)
+
+def test_mask_markdown():
+    for body in corpus():
+        assert tools.mask_markdown(body) == baseline.mask_markdown(body), repr(body)
+
+def test_mask_markdown_golden():
+    for (body, expected) in GOLDEN:
+        assert tools.mask_markdown(body) == expected, repr(body)
+        assert tools.unmask_markdown(expected[0], expected[1]) == body, repr(body)
+
+def test_masked_segments():
+    for body in corpus():
+        regions = []
+        segments = list(tools.iter_line_segments(tools.iter_masked_lines(body, regions)))
+        (masked, expected_regions) = baseline.mask_markdown(body)
+        assert (segments, regions) == (baseline.split_segments(masked), expected_regions), repr(body)
+
+def test_split_long_line():
+    rng = random.Random(2023)
+    for budget in [5, 8, 12, 20, 40]:
+        line = ''.join('中文' * rng.randint(0, 4) + f'@@M{i}@@' for i in range(200))
+        pieces = tools.split_long_line(line, budget)
+        assert ''.join(pieces) == line
+        for piece in pieces:
+            assert piece.count('@@') == 2 * len(tools.MASK_PATTERN.findall(piece)), repr(piece)
+
+if __name__ == '__main__':
+    test_split_segments()
+    test_mask_markdown()
+    test_mask_markdown_golden()
+    test_masked_segments()
+    test_split_long_line()
+    print('OK')
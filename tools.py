@@ -1,14 +1,99 @@
-import os, requests, openai, emoji
+import os, re, time, random, bisect, hashlib, sqlite3, threading, collections, concurrent.futures
+import requests, requests.adapters, openai, emoji
 from urllib.parse import urlparse
 
 GPT_MODEL="gpt-4-1106-preview"
 PROMPT_SYSTEM="Rephrase all user input text into simple, easy to understand, and technically toned English. Never answer questions but only translate or rephrase text to English."
+PROMPT_BATCH="The input has several items, each starts with a marker line like <<<1>>>. Translate or rephrase each item separately, and keep every marker line unchanged in the output."
 TRANS_MAGIC="TRANS_BY_GPT4"
 TRANS_DELIMETER = '\n\n'
 TRANS_DELIMETER_PR = '---------'
 LABEL_TRANS_NAME="TransByAI"
 LABEL_REFINED_NAME="RefinedByAI"
 LABEL_ENGLISH_NATIVE="EnglishNative"
+# The translation memory, set TRANS_CACHE_FILE to empty to disable it.
+TRANS_CACHE_FILE=".trans-cache.db"
+TRANS_CACHE_MAX_ENTRIES=100000
+TRANS_CACHE_MAX_AGE=90 * 24 * 3600
+# The number of segments to translate in parallel, 1 to translate one by one with the rolling context.
+TRANS_WORKERS=1
+# The max number of short segments to pack into one request, 1 to disable it.
+TRANS_BATCH_SIZE=1
+TRANS_BATCH_MAX_CHARS=200
+GITHUB_API_URL = 'https://api.github.com'
+GITHUB_GRAPHQL_URL = 'https://api.github.com/graphql'
+# The max connections of the GraphQL session, and the timeout in seconds of each request.
+GITHUB_GRAPHQL_POOL_SIZE=10
+GITHUB_GRAPHQL_TIMEOUT=60
+# Pause the GraphQL requests when the rate limit remaining points are less than the reserve, and pace them when
+# less than the slowdown points, see GithubRateBudget.
+GITHUB_RATE_RESERVE=100
+GITHUB_RATE_SLOWDOWN=1000
+# The max number of items to account the rate limit points, see GithubRateBudget.
+GITHUB_RATE_MAX_ITEMS=100
+# The max age in seconds of the cached label and category ids.
+GITHUB_ID_CACHE_MAX_AGE=7 * 24 * 3600
+# The max number of comment updates in one aliased GraphQL mutation document.
+GITHUB_MUTATION_BATCH_SIZE=20
+# The upper bounds in seconds of the latency histograms, see Metrics.
+METRICS_BUCKETS=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# The metrics to the type and help, exposed in Prometheus text format by the server, see Metrics.
+METRICS = {
+    'webhook_accept_seconds': ('histogram', 'The seconds to read, persist and acknowledge a webhook.'),
+    'webhook_events_total': ('counter', 'The webhook events by event and action.'),
+    'github_graphql_seconds': ('histogram', 'The seconds of GitHub GraphQL requests by kind, query or mutation.'),
+    'gpt_request_seconds': ('histogram', 'The seconds of each GPT request, including the failed ones.'),
+    'gpt_ttft_seconds': ('histogram', 'The seconds to the first token of each streaming GPT request, see TRANS_STREAM.'),
+    'forward_seconds': ('histogram', 'The seconds to forward a message to Discord or OpenCollective.'),
+    'translation_segments_total': ('counter', 'The segments by result, translated, already_translated or english.'),
+    'translation_cache_total': ('counter', 'The lookups of translation cache by result, hit or miss.'),
+    'retries_total': ('counter', 'The retries by kind, gpt or forward.'),
+    'errors_total': ('counter', 'The errors by kind, graphql, gpt, worker or forward.'),
+    'jobs_in_flight': ('gauge', 'The webhook events being handled by workers.'),
+    'queue_depth': ('gauge', 'The webhook events waiting for workers.'),
+    'forward_queue_depth': ('gauge', 'The messages waiting to forward.'),
+}
+# The shared limits of OpenAI requests and tokens per minute, 0 for no limit.
+GPT_RPM=0
+GPT_TPM=0
+# The retries of transient errors like 429, and the backoff delay in seconds.
+GPT_RETRY_MAX=5
+GPT_RETRY_BASE_DELAY=1
+GPT_RETRY_MAX_DELAY=60
+# Whether use the streaming completion, to report the time to first token, 0 to disable it.
+TRANS_STREAM=0
+# Whether mask the code blocks, logs, inline code and URLs before translation, 0 to disable it.
+TRANS_MASK_MARKDOWN=1
+MASK_PATTERN = re.compile(r'@@M(\d+)@@')
+MASK_INLINE_PATTERN = re.compile(r'`[^`\n]+`|\b(?:https?|rtmps?|rtsp|srt|webrtc|wss?)://[^\s<>()\[\]`]+')
+# The lines of logs and stack traces, for example, SRS logs, GDB backtraces, Java and Python stacks.
+MASK_LOG_PATTERN = re.compile(r'^\s*(?:\[\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}|#\d+\s+0x[0-9a-fA-F]+|at \S+\(.*\)\s*$|File ".*", line \d+)')
+# The max tokens of a segment in one request, 0 to derive from the GPT_MODEL_TOKENS of the model.
+TRANS_MAX_SEGMENT_TOKENS=0
+# The (context, output) tokens limit of models, matched by the longest prefix.
+GPT_MODEL_TOKENS = {
+    'gpt-3.5-turbo': (4096, 4096),
+    'gpt-3.5-turbo-16k': (16384, 4096),
+    'gpt-3.5-turbo-1106': (16384, 4096),
+    'gpt-4': (8192, 4096),
+    'gpt-4-32k': (32768, 4096),
+    'gpt-4-1106-preview': (128000, 4096),
+    'gpt-4-turbo': (128000, 4096),
+    'gpt-4o': (128000, 4096),
+}
+GPT_MODEL_TOKENS_DEFAULT = (8192, 4096)
+# The estimated tokens per character of scripts, 1 for others, see estimate_tokens.
+SCRIPT_TOKENS = {
+    'ASCII': 0.25,
+    'Latin': 0.5,
+    'Punctuation': 0.5,
+    'Greek': 0.75,
+    'Cyrillic': 0.75,
+    'CJK': 1.5,
+    'Kana': 1.5,
+    'Hangul': 1.5,
+    'Emoji': 2,
+}
 
 def github_token_init(token):
     if token is not None:
@@ -40,29 +125,127 @@ def openai_init(key, proxy):
     else:
         print("Warning: OPENAI_PROXY is not set")
 
+    trans_init()
+
+def trans_init():
+    """
+    Load the translation options from environment variables, for example, TRANS_WORKERS=4.
+    """
+    for name in ['TRANS_CACHE_FILE', 'TRANS_CACHE_MAX_ENTRIES', 'TRANS_CACHE_MAX_AGE', 'TRANS_WORKERS',
+                 'TRANS_BATCH_SIZE', 'TRANS_BATCH_MAX_CHARS', 'TRANS_MAX_SEGMENT_TOKENS', 'TRANS_MASK_MARKDOWN',
+                 'TRANS_STREAM', 'GPT_RPM', 'GPT_TPM', 'GPT_RETRY_MAX', 'GITHUB_GRAPHQL_POOL_SIZE',
+                 'GITHUB_GRAPHQL_TIMEOUT', 'GITHUB_MUTATION_BATCH_SIZE', 'GITHUB_ID_CACHE_MAX_AGE',
+                 'GITHUB_RATE_RESERVE', 'GITHUB_RATE_SLOWDOWN']:
+        value = os.environ.get(name)
+        if value is None:
+            continue
+        if isinstance(globals()[name], int):
+            value = int(value)
+        globals()[name] = value
+        print(f"Use {name}={value}")
+
+# The ASCII and single code point emojis, which are treated as English.
+ENGLISH_CHARS = frozenset([chr(c) for c in range(128)] + [c for c in emoji.EMOJI_DATA.keys() if len(c) == 1])
+# The script of Unicode ranges, sorted by the start code point, see detect_scripts.
+SCRIPT_RANGES = [
+    (0x0000, 0x007F, 'ASCII'),
+    (0x0080, 0x02AF, 'Latin'),
+    (0x0370, 0x03FF, 'Greek'),
+    (0x0400, 0x052F, 'Cyrillic'),
+    (0x0590, 0x05FF, 'Hebrew'),
+    (0x0600, 0x06FF, 'Arabic'),
+    (0x0E00, 0x0E7F, 'Thai'),
+    (0x1100, 0x11FF, 'Hangul'),
+    (0x1E00, 0x1EFF, 'Latin'),
+    (0x2000, 0x206F, 'Punctuation'),
+    (0x2E80, 0x303F, 'CJK'),
+    (0x3040, 0x30FF, 'Kana'),
+    (0x3100, 0x31FF, 'CJK'),
+    (0x3400, 0x4DBF, 'CJK'),
+    (0x4E00, 0x9FFF, 'CJK'),
+    (0xAC00, 0xD7AF, 'Hangul'),
+    (0xF900, 0xFAFF, 'CJK'),
+    (0xFE30, 0xFE4F, 'CJK'),
+    (0xFF00, 0xFFEF, 'CJK'),
+    (0x20000, 0x3134F, 'CJK'),
+]
+SCRIPT_RANGES_STARTS = [start for (start, end, script) in SCRIPT_RANGES]
+
 def already_english(str):
-    for c in str:
-        if len(c) != len(c.encode('utf-8')) and emoji.emoji_count(c) == 0:
-            return False
-    return True
+    if str.isascii():
+        return True
+    return ENGLISH_CHARS.issuperset(str)
+
+def detect_scripts(text):
+    """
+    Classify the characters of text by script, for example, {'ASCII': 10, 'CJK': 4, 'Emoji': 1}. The
+    single code point emojis are 'Emoji', and the characters not in SCRIPT_RANGES are 'Other'.
+    """
+    if text.isascii():
+        return {'ASCII': len(text)} if len(text) > 0 else {}
+
+    scripts = {}
+    for (c, count) in collections.Counter(text).items():
+        script = char_script(c)
+        scripts[script] = scripts.get(script, 0) + count
+    return scripts
+
+def char_script(c):
+    if c in ENGLISH_CHARS:
+        return 'ASCII' if c < '\x80' else 'Emoji'
+    code = ord(c)
+    index = bisect.bisect_right(SCRIPT_RANGES_STARTS, code) - 1
+    if index >= 0 and code <= SCRIPT_RANGES[index][1]:
+        return SCRIPT_RANGES[index][2]
+    return 'Other'
 
 def split_segments(body):
-    lines = body.split('\n')
-    matches = []
+    return list(iter_segments(body))
+
+def iter_segments(body):
+    """
+    Split body into segments of English and non-English lines, and yield each segment once it's complete. Each
+    line is classified exactly once, and only the lines of the current segment are kept in memory. An empty line
+    is kept as '\\n' in the current segment.
+    """
+    return iter_line_segments(iter_lines(body))
+
+def iter_line_segments(lines):
+    """
+    Yield the segments of the lines like iter_segments, for example, the masked lines of iter_masked_lines.
+    """
     current_matches = []
-    is_english = already_english(lines[0])
+    is_english = None
     for line in lines:
+        # The first line, even empty, decides the language of the first segment.
+        if is_english is None:
+            is_english = already_english(line)
+            current_matches.append(line if line != '' else '\n')
+            continue
         if line == '':
             current_matches.append('\n')
             continue
-        if already_english(line) == is_english:
+        line_is_english = already_english(line)
+        if line_is_english == is_english:
             current_matches.append(line)
         else:
-            matches.append('\n'.join(current_matches))
+            yield '\n'.join(current_matches)
             current_matches = [line]
-            is_english = already_english(line)
-    matches.append('\n'.join(current_matches))
-    return matches
+            is_english = line_is_english
+    yield '\n'.join(current_matches)
+
+def iter_lines(text):
+    """
+    Yield the lines of text like text.split('\\n'), without building the list.
+    """
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
 
 def wrap_magic(body, extra_delimeter=''):
     if TRANS_MAGIC in body:
@@ -76,45 +259,569 @@ def wrap_magic(body, extra_delimeter=''):
     return f"{body}{magic}"
 
 def gpt_translate(plaintext, trans_by_gpt):
-    segments = split_segments(plaintext)
-    final_trans = []
-    real_translated = False
+    return gpt_translate_many([plaintext], trans_by_gpt)[0]
+
+def gpt_translate_many(plaintexts, trans_by_gpt):
+    """
+    Translate several bodies together, for example, all comments of an issue, so that the short segments of
+    different bodies can be packed into one request, see TRANS_BATCH_SIZE. Return a list of (plaintext_trans,
+    trans_by_gpt, real_translated) like gpt_translate, one for each body.
+    """
+    job = TranslationJob(plaintexts, trans_by_gpt)
+
+    # The segments are translated while the later ones are still being split, except for the batch mode which
+    # needs all the short segments.
+    pending = job.pending()
+    translated = []
+    if TRANS_BATCH_SIZE > 1:
+        (translated, pending) = translate_segments_batched(list(pending))
+    if TRANS_WORKERS > 1:
+        translated += translate_segments_concurrently(pending)
+    else:
+        translated += translate_segments_sequentially(pending)
+
+    for (key, segment_trans) in translated:
+        unmasked = job.accept(key, segment_trans)
+        if unmasked is not None:
+            (segment_trans, add_to_messages) = translate_segment(unmasked, [{"role": "user", "content": unmasked}])
+            job.set(key, segment_trans)
+    return job.results()
+
+class TranslationJob:
+    """
+    The state of translating several bodies, used by gpt_translate_many. The pending() yields the segments to
+    translate, identified by the (body index, segment index), and the caller puts back the translations by accept().
+    """
+    def __init__(self, plaintexts, trans_by_gpt):
+        self.plaintexts = plaintexts
+        self.trans_by_gpt = trans_by_gpt
+        self.bodies = []
+        self.sources = {}
+
+    def pending(self):
+        for plaintext in self.plaintexts:
+            final_trans = []
+            # The regions are appended while the lines are masked, before the segment using them is yielded.
+            regions = []
+            lines = iter_masked_lines(plaintext, regions) if TRANS_MASK_MARKDOWN else iter_lines(plaintext)
+            body = {'final_trans': final_trans, 'regions': regions, 'trans_by_gpt': self.trans_by_gpt, 'real_translated': False}
+            self.bodies.append(body)
+            for segment in iter_line_segments(lines):
+                # Directly keep the empty line.
+                if segment.strip() == '':
+                    final_trans.append(segment)
+                    continue
+
+                print(f"\n<<<<<<<<<<<< {segment.strip()} >>>>>>>>>>>>")
+                if TRANS_MAGIC in segment:
+                    body['trans_by_gpt'] = True
+                    print(f"<<<<<<<<<<<< Already translated, skip >>>>>>>>>>>>\n")
+                    metrics().inc('translation_segments_total', result='already_translated')
+                    final_trans.append(segment)
+                elif already_english(segment):
+                    print(f"<<<<<<<<<<<< Already English, skip >>>>>>>>>>>>\n")
+                    metrics().inc('translation_segments_total', result='english')
+                    final_trans.append(segment)
+                else:
+                    body['real_translated'] = body['trans_by_gpt'] = True
+                    metrics().inc('translation_segments_total', result='translated')
+                    key = (len(self.bodies) - 1, len(final_trans))
+                    self.sources[key] = segment
+                    final_trans.append(None)
+                    yield (key, segment)
+
+    def accept(self, key, segment_trans):
+        """
+        Put back the translation of a segment. If GPT breaks the placeholders, return the unmasked segment, which
+        should be translated again and put back by set().
+        """
+        source = self.sources[key]
+        if not placeholders_kept(source, segment_trans):
+            print(f"Warning!!! Placeholders changed, translate the unmasked segment, {segment_trans}")
+            return unmask_markdown(source, self.bodies[key[0]]['regions'])
+        self.set(key, segment_trans)
+        return None
+
+    def set(self, key, segment_trans):
+        (body_index, index) = key
+        self.bodies[body_index]['final_trans'][index] = segment_trans
+
+def placeholders_kept(segment, segment_trans):
+    """
+    Whether the translation keeps all the placeholders of the segment, see mask_markdown.
+    """
+    return sorted(MASK_PATTERN.findall(segment)) == sorted(MASK_PATTERN.findall(segment_trans))
+
+    def results(self):
+        results = []
+        for body in self.bodies:
+            plaintext_trans = "\n".join(body['final_trans']).strip('\n')
+            plaintext_trans = unmask_markdown(plaintext_trans, body['regions'])
+            results.append((plaintext_trans, body['trans_by_gpt'], body['real_translated']))
+        return results
+
+def mask_markdown(text):
+    """
+    Replace the regions which are not prose with placeholders like @@M0@@, so only the prose is sent to GPT. The
+    regions are code blocks, including the suggestion blocks of PR review, log lines and stack traces, inline code
+    and URLs. Return the masked text and the regions, see unmask_markdown.
+    """
+    regions = []
+    return ('\n'.join(iter_masked_lines(text, regions)), regions)
+
+def iter_masked_lines(text, regions):
+    """
+    Yield the masked lines of text like mask_markdown, line by line, and append the masked regions to regions.
+    Only the lines of the current code block or logs are kept in memory.
+    """
+    # Never mask the text which already looks like having placeholders.
+    if '@@M' in text:
+        yield from iter_lines(text)
+        return
+
+    def placeholder(lines):
+        regions.append('\n'.join(lines))
+        return f"@@M{len(regions) - 1}@@"
+    def mask_inline(matched):
+        if TRANS_MAGIC in matched.group(0):
+            return matched.group(0)
+        return placeholder([matched.group(0)])
+
+    # The fence and lines of the current code block, and the lines of the current logs.
+    (fence, block, logs) = (None, [], [])
+    for line in iter_lines(text):
+        if fence is not None:
+            block.append(line)
+            if line.strip().startswith(fence):
+                yield placeholder(block)
+                (fence, block) = (None, [])
+            continue
+        if MASK_LOG_PATTERN.match(line) is not None:
+            logs.append(line)
+            continue
+        if len(logs) > 0:
+            yield placeholder(logs)
+            logs = []
+        if line.strip()[:3] in ['```', '~~~']:
+            (fence, block) = (line.strip()[:3], [line])
+            continue
+        yield MASK_INLINE_PATTERN.sub(mask_inline, line)
+
+    # The unclosed code block lasts to the end.
+    if len(logs) > 0:
+        yield placeholder(logs)
+    if fence is not None:
+        yield placeholder(block)
+
+def unmask_markdown(text, regions):
+    """
+    Restore the regions masked by mask_markdown, byte for byte.
+    """
+    if len(regions) == 0:
+        return text
+    def restore(matched):
+        index = int(matched.group(1))
+        if index >= len(regions):
+            return matched.group(0)
+        return regions[index]
+    return MASK_PATTERN.sub(restore, text)
+
+def translate_segments_sequentially(pending):
+    """
+    Translate segments one by one, with a rolling context of the previous segment and its translation, which
+    keeps the terminology consistent across segments. The context is reset for each body.
+    """
+    translated = []
     messages = []
-    for segment in segments:
-        # Directly keep the empty line.
-        if segment.strip() == '':
-            final_trans.append(segment)
+    current_body = None
+    for ((body_index, index), segment) in pending:
+        if body_index != current_body:
+            current_body = body_index
+            messages = []
+        messages.append({"role": "user", "content": segment})
+        if len(messages) > 3:
+            messages = messages[-3:]
+        (segment_trans, add_to_messages) = translate_segment(segment, messages)
+        print(f"<<<<<<<<<<<< {segment_trans.strip()} >>>>>>>>>>>>\n")
+        if add_to_messages:
+            messages.append({"role": "assistant", "content": segment_trans})
+        translated.append(((body_index, index), segment_trans))
+    return translated
+
+def translate_segments_batched(pending):
+    """
+    Pack the short segments, no longer than TRANS_BATCH_MAX_CHARS, into requests of at most TRANS_BATCH_SIZE
+    segments. Return the translated segments, and the segments left to translate one by one, which are the long
+    segments, and the segments of a batch whose output can't be parsed.
+    """
+    (translated, batches, remaining) = plan_batches(pending)
+    for batch in batches:
+        starttime = time.time()
+        try:
+            segments_trans = do_gpt_translate_batch([segment for (key, segment) in batch], PROMPT_SYSTEM)
+        except TranslationBatchError as e:
+            print(f"Warning!!! Fallback to translate {len(batch)} segments one by one, {e}")
+            remaining += batch
             continue
+        translated += accept_batch(batch, segments_trans, time.time() - starttime)
+    return (translated, remaining)
 
-        print(f"\n<<<<<<<<<<<< {segment.strip()} >>>>>>>>>>>>")
-        if TRANS_MAGIC in segment:
-            trans_by_gpt = True
-            print(f"<<<<<<<<<<<< Already translated, skip >>>>>>>>>>>>\n")
-            final_trans.append(segment)
-        elif already_english(segment):
-            print(f"<<<<<<<<<<<< Already English, skip >>>>>>>>>>>>\n")
-            final_trans.append(segment)
-        else:
-            real_translated = trans_by_gpt = True
-            messages.append({"role": "user", "content": segment})
+def plan_batches(pending):
+    """
+    Return the segments translated by cache, the batches of short segments, and the long segments.
+    """
+    cache = trans_cache()
+    translated = []
+    batchable = []
+    remaining = []
+    for (key, segment) in pending:
+        if len(segment) > TRANS_BATCH_MAX_CHARS:
+            remaining.append((key, segment))
+            continue
+        cached = cache.get(segment) if cache is not None else None
+        if cached is not None:
+            print(f"<<<<<<<<<<<< Hit translation cache, {segment.strip()} >>>>>>>>>>>>")
+            translated.append((key, cached))
+            continue
+        batchable.append((key, segment))
+
+    # Not worth to pack a single segment.
+    if len(batchable) < 2:
+        return (translated, [], batchable + remaining)
+
+    batches = []
+    for i in range(0, len(batchable), TRANS_BATCH_SIZE):
+        batches.append(batchable[i:i+TRANS_BATCH_SIZE])
+    return (translated, batches, remaining)
+
+def accept_batch(batch, segments_trans, elapsed):
+    cache = trans_cache()
+    translated = []
+    for ((key, segment), segment_trans) in zip(batch, segments_trans):
+        print(f"<<<<<<<<<<<< {segment.strip()} >>>>>>>>>>>>")
+        print(f"<<<<<<<<<<<< {segment_trans.strip()} >>>>>>>>>>>>\n")
+        # Never cache the translation which breaks the placeholders, it's translated again by accept().
+        if cache is not None and placeholders_kept(segment, segment_trans):
+            cache.put(segment, segment_trans, elapsed / len(batch))
+        translated.append((key, segment_trans))
+    return translated
+
+def translate_segments_concurrently(pending):
+    """
+    Translate segments in parallel by at most TRANS_WORKERS workers, and reassemble in the original order.
+
+    The rolling context is not available in this mode, because the translation of the previous segment is not
+    ready when the next one starts. So each segment is translated independently with only the system prompt,
+    which trades a little terminology consistency across segments for latency.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=TRANS_WORKERS) as executor:
+        futures = []
+        for (key, segment) in pending:
+            messages = [{"role": "user", "content": segment}]
+            futures.append((key, executor.submit(translate_segment, segment, messages)))
+
+        translated = []
+        for (key, future) in futures:
+            (segment_trans, add_to_messages) = future.result()
+            print(f"<<<<<<<<<<<< {segment_trans.strip()} >>>>>>>>>>>>\n")
+            translated.append((key, segment_trans))
+        return translated
+
+def translate_segment(segment, messages):
+    if estimate_tokens(segment) > gpt_segment_budget():
+        return translate_oversized_segment(segment)
+
+    cache = trans_cache()
+    if cache is not None:
+        cached = cache.get(segment)
+        if cached is not None:
+            print(f"<<<<<<<<<<<< Hit translation cache >>>>>>>>>>>>")
+            return (cached, True)
+
+    messages = fit_gpt_context(messages)
+    starttime = time.time()
+    # The transient errors are retried by gpt_chat_completion.
+    (segment_trans, add_to_messages) = do_gpt_translate(segment, PROMPT_SYSTEM, messages)
+
+    # Only cache the real translation, not the source text for context_length_exceeded, nor the translation which
+    # breaks the placeholders.
+    if cache is not None and add_to_messages and placeholders_kept(segment, segment_trans):
+        cache.put(segment, segment_trans, time.time() - starttime)
+    return (segment_trans, add_to_messages)
+
+def translate_oversized_segment(segment):
+    """
+    Split the segment which exceeds the token budget at markdown-safe boundaries, translate the chunks one by one
+    and stitch them back. The stitched translation is too large for the rolling context, so never add it.
+    """
+    budget = gpt_segment_budget()
+    chunks = split_markdown_chunks(segment, budget)
+    print(f"<<<<<<<<<<<< Split {estimate_tokens(segment)} tokens into {len(chunks)} chunks, budget={budget} >>>>>>>>>>>>")
+
+    chunks_trans = []
+    messages = []
+    for chunk in chunks:
+        if chunk.strip() == '' or already_english(chunk):
+            chunks_trans.append(chunk)
+            continue
+        # Never send a code block which is still too large, it's mostly logs.
+        if estimate_tokens(chunk) > budget and chunk.lstrip()[:3] in ['```', '~~~']:
+            print(f"Warning!!! Use source text for code block exceeds budget, length={len(chunk)}")
+            chunks_trans.append(chunk)
+            continue
+
+        # Only a very long line is still too large, split it to sentences.
+        pieces_trans = []
+        for piece in split_long_line(chunk, budget):
+            # Never translate the piece which can't be split smaller, or it's split again and again.
+            if estimate_tokens(piece) > budget:
+                print(f"Warning!!! Use source text for piece exceeds budget, length={len(piece)}")
+                pieces_trans.append(piece)
+                continue
+            messages.append({"role": "user", "content": piece})
             if len(messages) > 3:
                 messages = messages[-3:]
-            retry = 3
-            add_to_messages = False
-            for i in range(retry):
-                try:
-                    (segment_trans, add_to_messages) = do_gpt_translate(segment, PROMPT_SYSTEM, messages)
-                    break
-                except Exception as e:
-                    if i == retry - 1:
-                        raise e
-                    print(f"Warning!!! GPT retry {i+1} times, ignore {e}")
-            print(f"<<<<<<<<<<<< {segment_trans.strip()} >>>>>>>>>>>>\n")
+            (piece_trans, add_to_messages) = translate_segment(piece, messages)
             if add_to_messages:
-                messages.append({"role": "assistant", "content": segment_trans})
-            final_trans.append(segment_trans)
-    plaintext_trans = "\n".join(final_trans).strip('\n')
-    return (plaintext_trans, trans_by_gpt, real_translated)
+                messages.append({"role": "assistant", "content": piece_trans})
+            pieces_trans.append(piece_trans)
+        chunks_trans.append(''.join(pieces_trans))
+    return ('\n'.join(chunks_trans), False)
+
+def estimate_tokens(text):
+    """
+    Estimate the tokens of text offline by the scripts, for example, about 4 ASCII characters per token, and 1.5
+    tokens per CJK character. It's a bit larger than the real tokens, to be safe.
+    """
+    tokens = 0
+    for (script, count) in detect_scripts(text).items():
+        tokens += count * SCRIPT_TOKENS.get(script, 1)
+    return int(tokens) + 1
+
+def gpt_model_tokens(model):
+    """
+    Return the (context, output) tokens limit of the model, by the longest prefix matched.
+    """
+    matched = None
+    for prefix in GPT_MODEL_TOKENS.keys():
+        if model.startswith(prefix) and (matched is None or len(prefix) > len(matched)):
+            matched = prefix
+    if matched is None:
+        return GPT_MODEL_TOKENS_DEFAULT
+    return GPT_MODEL_TOKENS[matched]
+
+def gpt_segment_budget():
+    """
+    The max tokens of a segment to translate in one request. The output is about as long as the input, and there
+    is also the rolling context of the previous segment and its translation.
+    """
+    if TRANS_MAX_SEGMENT_TOKENS > 0:
+        return TRANS_MAX_SEGMENT_TOKENS
+    (context, output) = gpt_model_tokens(GPT_MODEL)
+    return min(output, (context - estimate_tokens(PROMPT_SYSTEM)) // 4)
+
+def fit_gpt_context(messages):
+    """
+    Drop the oldest context messages, to leave room for the output in the context window. The last message
+    which is the segment to translate is always kept.
+    """
+    (context, output) = gpt_model_tokens(GPT_MODEL)
+    tokens = [estimate_tokens(message['content']) for message in messages]
+    # Reserve the output about as long as the segment to translate.
+    total = estimate_tokens(PROMPT_SYSTEM) + sum(tokens) + tokens[-1]
+    while len(messages) > 1 and total > context:
+        total -= tokens[0]
+        messages = messages[1:]
+        tokens = tokens[1:]
+    return messages
+
+def split_markdown_chunks(text, budget):
+    """
+    Split text into chunks no larger than budget tokens, at the boundaries of paragraphs and list items, and
+    never inside a code fence. A block larger than the budget is split by lines, except the code fence which is
+    kept as a whole. The '\\n'.join(chunks) is exactly the text.
+    """
+    blocks = []
+    block = []
+    fence = None
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if fence is not None:
+            block.append(line)
+            if stripped.startswith(fence):
+                blocks.append((block, True))
+                (block, fence) = ([], None)
+            continue
+
+        if stripped.startswith('```') or stripped.startswith('~~~'):
+            if len(block) > 0:
+                blocks.append((block, False))
+            (block, fence) = ([line], stripped[:3])
+        elif stripped == '' or re.match(r'^\s*([-*+]|\d+[.)])\s', line) is not None:
+            if len(block) > 0:
+                blocks.append((block, False))
+            block = [line]
+        else:
+            block.append(line)
+    if len(block) > 0:
+        blocks.append((block, fence is not None))
+
+    chunks = []
+    current = []
+    current_tokens = 0
+    for (lines, is_fence) in blocks:
+        tokens = estimate_tokens('\n'.join(lines))
+        # Split the large block by lines, except the code fence.
+        if tokens > budget and not is_fence:
+            pieces = [[line] for line in lines]
+        else:
+            pieces = [lines]
+        for piece in pieces:
+            tokens = estimate_tokens('\n'.join(piece))
+            if len(current) > 0 and current_tokens + tokens > budget:
+                chunks.append('\n'.join(current))
+                (current, current_tokens) = ([], 0)
+            current += piece
+            current_tokens += tokens
+    if len(current) > 0:
+        chunks.append('\n'.join(current))
+    return chunks
+
+def split_long_line(line, budget):
+    """
+    Split a line into pieces no larger than budget tokens, at the end of sentences, or by characters if a single
+    sentence is too large. The ''.join(pieces) is exactly the line.
+    """
+    if estimate_tokens(line) <= budget:
+        return [line]
+
+    sentences = []
+    for sentence in re.split(r'(?<=[。！？；.!?;])', line):
+        while estimate_tokens(sentence) > budget:
+            # The budget is in tokens, and a character is at most max(SCRIPT_TOKENS) tokens, for example, emoji.
+            size = max(1, int(budget / max(SCRIPT_TOKENS.values())) - 1)
+            # Never cut inside a placeholder like @@M1@@, or it can't be restored.
+            for m in MASK_PATTERN.finditer(sentence, max(0, size - 16), size + 16):
+                if m.start() < size < m.end():
+                    size = m.start() if m.start() > 0 else m.end()
+                    break
+            sentences.append(sentence[:size])
+            sentence = sentence[size:]
+        sentences.append(sentence)
+
+    pieces = []
+    current = ''
+    for sentence in sentences:
+        if current != '' and estimate_tokens(current + sentence) > budget:
+            pieces.append(current)
+            current = ''
+        current += sentence
+    if current != '':
+        pieces.append(current)
+    return pieces
+
+class TranslationCache:
+    """
+    The on-disk translation memory, keyed by the normalized segment, GPT_MODEL and PROMPT_SYSTEM,
+    evicted by age (TRANS_CACHE_MAX_AGE in seconds) and size (TRANS_CACHE_MAX_ENTRIES).
+    """
+    def __init__(self, filename, max_entries, max_age):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS translations (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                translated TEXT NOT NULL,
+                elapsed REAL NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        self.db.execute("CREATE INDEX IF NOT EXISTS translations_accessed_at ON translations(accessed_at)")
+        self.db.commit()
+        self.evict()
+
+    @staticmethod
+    def normalize(text):
+        lines = text.replace('\r\n', '\n').split('\n')
+        return '\n'.join([line.rstrip() for line in lines]).strip()
+
+    @staticmethod
+    def key(text):
+        material = f"{GPT_MODEL}\n{PROMPT_SYSTEM}\n{TranslationCache.normalize(text)}"
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, text):
+        key = TranslationCache.key(text)
+        with self.lock:
+            row = self.db.execute("SELECT translated, elapsed, created_at FROM translations WHERE key=?", (key,)).fetchone()
+            if row is None or time.time() - row[2] > self.max_age:
+                self.misses += 1
+                metrics().inc('translation_cache_total', result='miss')
+                return None
+            self.db.execute("UPDATE translations SET accessed_at=? WHERE key=?", (time.time(), key))
+            self.db.commit()
+            self.hits += 1
+            self.saved_seconds += row[1]
+            metrics().inc('translation_cache_total', result='hit')
+            return row[0]
+
+    def put(self, text, translated, elapsed):
+        key = TranslationCache.key(text)
+        now = time.time()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?, ?)", (
+                key, GPT_MODEL, translated, elapsed, now, now,
+            ))
+            self.db.commit()
+            self.puts += 1
+        if self.puts % 100 == 0:
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            self.db.execute("DELETE FROM translations WHERE created_at < ?", (time.time() - self.max_age,))
+            self.db.execute('''
+                DELETE FROM translations WHERE key IN (
+                    SELECT key FROM translations ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+            ''', (self.max_entries,))
+            self.db.commit()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'saved_seconds': self.saved_seconds,
+        }
+
+    def summary(self):
+        return f"hits={self.hits}, misses={self.misses}, saved {self.hits} API calls and {self.saved_seconds:.1f}s"
+
+_trans_cache = None
+_trans_cache_lock = threading.Lock()
+def trans_cache():
+    global _trans_cache
+    if TRANS_CACHE_FILE is None or TRANS_CACHE_FILE == '':
+        return None
+    with _trans_cache_lock:
+        if _trans_cache is None:
+            _trans_cache = TranslationCache(TRANS_CACHE_FILE, TRANS_CACHE_MAX_ENTRIES, TRANS_CACHE_MAX_AGE)
+        return _trans_cache
+
+def trans_cache_summary():
+    cache = trans_cache()
+    if cache is None:
+        return "disabled"
+    return cache.summary()
 
 def do_gpt_translate(plaintext, system, messages):
     try:
@@ -122,31 +829,11 @@ def do_gpt_translate(plaintext, system, messages):
         if system is not None:
             prompts.insert(0, {"role": "system", "content": system})
 
-        completion = openai.ChatCompletion.create(
-            model=GPT_MODEL,
-            messages=prompts,
-            temperature=0,
-        )
-        translated = completion.choices[0].message.content.strip('\'"')
-
-        # Filter:
-        #       'safari推流rtc失败' translates to 'Safari streaming RTC failed' in English
-        # to:
-        #       Safari streaming RTC failed
-        if f"{plaintext}' translates to '" in translated:
-            translated = translated.split("' translates to '")[1]
-            if "' in English" in translated:
-                translated = translated.split("' in English")[0]
-
-        # Filter:
-        #       We can discuss more clearly on Discord.
-        #       Please ensure to maintain the markdown structure.
-        # to:
-        #       We can discuss more clearly on Discord.
-        lines = translated.split('\n')
-        if len(lines) > 0 and 'maintain' in lines[-1] and 'markdown structure' in lines[-1]:
-            translated = '\n'.join(lines[:-1])
+        if TRANS_STREAM:
+            return (do_gpt_translate_stream(plaintext, prompts), True)
 
+        completion = gpt_chat_completion(prompts)
+        translated = filter_translated(plaintext, completion.choices[0].message.content)
         return (translated, True)
     except openai.InvalidRequestError as e:
         if e.code == 'context_length_exceeded':
@@ -154,18 +841,319 @@ def do_gpt_translate(plaintext, system, messages):
             return (plaintext, False)
         raise e
 
+def filter_translated(plaintext, translated):
+    translated = translated.strip('\'"')
+
+    # Filter:
+    #       'safari推流rtc失败' translates to 'Safari streaming RTC failed' in English
+    # to:
+    #       Safari streaming RTC failed
+    if f"{plaintext}' translates to '" in translated:
+        translated = translated.split("' translates to '")[1]
+        if "' in English" in translated:
+            translated = translated.split("' in English")[0]
+
+    # Filter:
+    #       We can discuss more clearly on Discord.
+    #       Please ensure to maintain the markdown structure.
+    # to:
+    #       We can discuss more clearly on Discord.
+    lines = translated.split('\n')
+    if len(lines) > 0 and 'maintain' in lines[-1] and 'markdown structure' in lines[-1]:
+        translated = '\n'.join(lines[:-1])
+
+    return translated
+
+def do_gpt_translate_stream(plaintext, prompts):
+    """
+    Translate by the streaming completion, then filter the whole text by filter_translated. The output is used only
+    when the stream is done, the streaming is only for measuring. Print the time to first token and the total time
+    of the last attempt, and record the time to first token to the gpt_ttft_seconds of metrics.
+    """
+    starttime = ttft = None
+    def request():
+        nonlocal starttime, ttft
+        # Reset for each attempt, so the retries and the backoff are not counted.
+        (starttime, ttft) = (time.time(), None)
+        deltas = []
+        for chunk in openai.ChatCompletion.create(
+            model=GPT_MODEL,
+            messages=prompts,
+            temperature=0,
+            stream=True,
+        ):
+            if len(chunk.choices) == 0:
+                continue
+            delta = chunk.choices[0].delta.get('content')
+            if delta is None or delta == '':
+                continue
+            if ttft is None:
+                ttft = time.time() - starttime
+            deltas.append(delta)
+        return filter_translated(plaintext, ''.join(deltas))
+    translated = gpt_with_retry(request, estimate_prompts_tokens(prompts))
+
+    ttft = ttft if ttft is not None else time.time() - starttime
+    metrics().observe('gpt_ttft_seconds', ttft)
+    print(f"<<<<<<<<<<<< Stream TTFT={int(ttft * 1000)}ms, total={int((time.time() - starttime) * 1000)}ms, {len(translated)} chars >>>>>>>>>>>>")
+    return translated
+
+class TranslationBatchError(Exception):
+    pass
+
+def do_gpt_translate_batch(segments, system):
+    """
+    Translate several segments in one request, each segment starts with a marker line like <<<1>>>, and split
+    the output back by the markers. Raise TranslationBatchError if the request fails or the output doesn't
+    parse, then the caller should translate the segments one by one.
+    """
+    try:
+        completion = gpt_chat_completion(batch_prompts(segments, system))
+    except openai.OpenAIError as e:
+        raise TranslationBatchError(f"request failed, {e}")
+
+    items = parse_batch_translation(completion.choices[0].message.content, len(segments))
+    return [filter_translated(segment, item) for (segment, item) in zip(segments, items)]
+
+def batch_prompts(segments, system):
+    content = []
+    for (index, segment) in enumerate(segments):
+        content.append(f"<<<{index+1}>>>")
+        content.append(segment.strip('\n'))
+    return [
+        {"role": "system", "content": f"{system} {PROMPT_BATCH}"},
+        {"role": "user", "content": '\n'.join(content)},
+    ]
+
+def parse_batch_translation(text, count):
+    items = {}
+    current = None
+    for line in text.split('\n'):
+        matched = re.match(r'^\s*<<<(\d+)>>>\s*$', line)
+        if matched is not None:
+            current = int(matched.group(1))
+            if current in items:
+                raise TranslationBatchError(f"duplicated marker {current}")
+            items[current] = []
+            continue
+        if current is None:
+            if line.strip() == '':
+                continue
+            raise TranslationBatchError(f"text before the first marker, {line}")
+        items[current].append(line)
+
+    if sorted(items.keys()) != list(range(1, count + 1)):
+        raise TranslationBatchError(f"markers mismatch, expect {count} got {sorted(items.keys())}")
+
+    results = []
+    for index in range(1, count + 1):
+        item = '\n'.join(items[index]).strip('\n')
+        if item.strip() == '':
+            raise TranslationBatchError(f"empty item {index}")
+        results.append(item)
+    return results
+
 def gpt_refine_pr(plaintext):
     messages = []
     messages.append({"role": "system", "content": PROMPT_SYSTEM})
     messages.append({"role": "user", "content": plaintext})
-    completion = openai.ChatCompletion.create(
-        model=GPT_MODEL,
-        messages=messages,
-        temperature=0,
-    )
+    completion = gpt_chat_completion(messages)
     trans = completion.choices[0].message.content.strip('\'"')
     return trans
 
+def gpt_chat_completion(prompts):
+    """
+    Create a ChatCompletion under the shared rate limiter, retry the transient errors, and settle the tokens by
+    the actual usage of the response.
+    """
+    tokens = estimate_prompts_tokens(prompts)
+    completion = gpt_with_retry(lambda: openai.ChatCompletion.create(
+        model=GPT_MODEL,
+        messages=prompts,
+        temperature=0,
+    ), tokens)
+    usage = getattr(completion, 'usage', None)
+    if usage is not None:
+        gpt_rate_limiter().settle(tokens, usage.total_tokens)
+    return completion
+
+def estimate_prompts_tokens(prompts):
+    """
+    Estimate the tokens of a request, the prompts and the output which is about as long as the last message.
+    """
+    tokens = [estimate_tokens(prompt['content']) for prompt in prompts]
+    return sum(tokens) + tokens[-1]
+
+def gpt_with_retry(request, tokens):
+    """
+    Call request under the shared rate limiter, and retry the transient errors, such as 429 and 5xx, by jittered
+    exponential backoff, which honors the Retry-After header. The other errors are raised immediately.
+    """
+    # The first attempt and at most GPT_RETRY_MAX retries, so 0 disables the retry.
+    attempts = max(0, GPT_RETRY_MAX) + 1
+    for i in range(attempts):
+        gpt_rate_limiter().acquire(tokens)
+        starttime = time.time()
+        try:
+            return request()
+        except (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError,
+                openai.error.Timeout, openai.error.TryAgain, openai.error.APIConnectionError) as e:
+            metrics().inc('errors_total', kind='gpt')
+            if i == attempts - 1:
+                raise e
+            delay = gpt_retry_delay(e, i)
+            print(f"Warning!!! GPT retry {i+1} times after {delay:.1f}s, {type(e).__name__} {e}")
+            metrics().inc('retries_total', kind='gpt')
+            time.sleep(delay)
+        finally:
+            metrics().observe('gpt_request_seconds', time.time() - starttime)
+
+def gpt_retry_delay(e, attempt):
+    """
+    The delay before the next retry, the Retry-After of the response if any, or the full jitter exponential
+    backoff, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+    backoff = random.uniform(0, min(GPT_RETRY_MAX_DELAY, GPT_RETRY_BASE_DELAY * (2 ** attempt)))
+    headers = e.headers if e.headers is not None else {}
+    for (key, value) in headers.items():
+        if key.lower() != 'retry-after':
+            continue
+        try:
+            return max(float(value), backoff)
+        except ValueError:
+            pass
+    return backoff
+
+class RateLimiter:
+    """
+    A token bucket for both requests per minute and tokens per minute, shared by all threads. Set rpm or tpm to 0
+    for no limit. The cost is reserved before waiting, so the callers are served in order, and the tokens bucket
+    is corrected by the actual usage, see settle.
+    """
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.time()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def reserve(self, tokens):
+        """
+        Take a request and the tokens from the buckets, and return the seconds to wait before sending it.
+        """
+        with self.lock:
+            self.refill()
+            wait = 0
+            if self.rpm > 0:
+                self.requests -= 1
+                if self.requests < 0:
+                    wait = max(wait, -self.requests * 60 / self.rpm)
+            if self.tpm > 0:
+                # A request larger than the bucket should wait for the full bucket, not forever.
+                self.tokens -= min(tokens, self.tpm)
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens * 60 / self.tpm)
+            return wait
+
+    def acquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            print(f"Rate limited, wait {wait:.1f}s for {tokens} tokens, rpm={self.rpm}, tpm={self.tpm}")
+            time.sleep(wait)
+
+    def settle(self, estimated, actual):
+        if self.tpm <= 0:
+            return
+        with self.lock:
+            self.tokens = min(self.tpm, self.tokens + min(estimated, self.tpm) - actual)
+
+_gpt_rate_limiter = None
+_gpt_rate_limiter_lock = threading.Lock()
+def gpt_rate_limiter():
+    global _gpt_rate_limiter
+    with _gpt_rate_limiter_lock:
+        if _gpt_rate_limiter is None:
+            _gpt_rate_limiter = RateLimiter(GPT_RPM, GPT_TPM)
+        return _gpt_rate_limiter
+
+class Metrics:
+    """
+    The counters, gauges and histograms declared in METRICS, shared by all threads, and rendered in Prometheus
+    text format, see https://prometheus.io/docs/instrumenting/exposition_formats/ The labels are keyword arguments,
+    for example, metrics().inc('webhook_events_total', event='issues', action='opened').
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The name to the labels to the value, or [bucket counts, sum, count] for histogram.
+        self.values = collections.defaultdict(dict)
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, seconds, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values[name]:
+                self.values[name][key] = [[0] * len(self.buckets), 0, 0]
+            histogram = self.values[name][key]
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @staticmethod
+    def format_labels(labels):
+        if len(labels) == 0:
+            return ''
+        escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for (k, v) in labels]
+        return '{' + ','.join([f'{k}="{v}"' for (k, v) in escaped]) + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for (name, (kind, help)) in METRICS.items():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (labels, value) in self.values.get(name, {}).items():
+                    if kind != 'histogram':
+                        lines.append(f"{name}{Metrics.format_labels(labels)} {value}")
+                        continue
+                    (counts, total, count) = value
+                    cumulative = 0
+                    for (bound, bucket) in zip(self.buckets, counts):
+                        cumulative += bucket
+                        lines.append(f"{name}_bucket{Metrics.format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{Metrics.format_labels(labels + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{Metrics.format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{Metrics.format_labels(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+_metrics = None
+_metrics_lock = threading.Lock()
+def metrics():
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(METRICS_BUCKETS)
+        return _metrics
+
 def get_graphql_headers():
     return {
         "Content-Type": "application/json",
@@ -209,7 +1197,11 @@ class GithubGraphQLException(Exception):
         super().__init__(message)
         self.res = res
         self.text = res.text
-        self.json = res.json()
+        # The body might not be JSON for HTTP errors, for example, 502 Bad Gateway.
+        try:
+            self.json = res.json()
+        except ValueError:
+            self.json = {}
         self.errors = None
         if 'errors' in self.json:
             self.errors = self.json['errors']
@@ -226,6 +1218,298 @@ class GithubGraphQLException(Exception):
                     return True
         return False
 
+    def is_not_found(self):
+        if self.errors is not None and len(self.errors) > 0:
+            for error in self.errors:
+                # For example: Could not resolve to a node with the global id of 'xxx'
+                if error.get('type') == 'NOT_FOUND':
+                    return True
+        return False
+
+class GithubGraphQLClient:
+    """
+    The GitHub GraphQL client with a pooled keep-alive session shared by all threads, which maps the HTTP and
+    GraphQL errors to GithubGraphQLException, and times each call by the operation, see summary().
+    """
+    def __init__(self, pool_size):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        # The operation, for example, updateIssueComment, to [count, errors, total seconds, max seconds].
+        self.stats = {}
+
+    def request(self, query, variables):
+        operation = graphql_operation(query)
+        budget = github_rate_budget()
+        budget.acquire()
+        starttime = time.time()
+        res = None
+        try:
+            res = self.session.post(GITHUB_GRAPHQL_URL, json={"query": with_rate_limit(query), "variables": variables},
+                headers=get_graphql_headers(), timeout=GITHUB_GRAPHQL_TIMEOUT)
+        finally:
+            self.record(operation, time.time() - starttime, res is None or res.status_code != 200)
+            metrics().observe('github_graphql_seconds', time.time() - starttime,
+                kind='mutation' if query.lstrip().startswith('mutation') else 'query')
+
+        if res.status_code != 200:
+            budget.update(res.status_code, res.headers, None)
+            metrics().inc('errors_total', kind='graphql')
+            raise GithubGraphQLException(f"request failed, code={res.status_code}", res)
+
+        j_res = res.json()
+        budget.update(res.status_code, res.headers, j_res)
+        if 'errors' in j_res:
+            with self.lock:
+                self.stats[operation][1] += 1
+            metrics().inc('errors_total', kind='graphql')
+            raise GithubGraphQLException(f"request failed, {j_res}", res)
+        return j_res
+
+    def record(self, operation, elapsed, failed):
+        with self.lock:
+            if operation not in self.stats:
+                self.stats[operation] = [0, 0, 0, 0]
+            stat = self.stats[operation]
+            stat[0] += 1
+            stat[1] += 1 if failed else 0
+            stat[2] += elapsed
+            stat[3] = max(stat[3], elapsed)
+
+    def prewarm(self):
+        """
+        Establish the TCP and TLS connection to GitHub API ahead, without any GraphQL rate limit cost.
+        """
+        starttime = time.time()
+        try:
+            self.session.head(GITHUB_API_URL, timeout=GITHUB_GRAPHQL_TIMEOUT)
+            print(f"Prewarm GitHub API connection ok, {int((time.time() - starttime) * 1000)}ms")
+        except requests.RequestException as e:
+            print(f"Warning!!! Ignore prewarm GitHub API connection failed, {e}")
+
+    def summary(self):
+        with self.lock:
+            logs = []
+            for (operation, (count, errors, total, longest)) in self.stats.items():
+                logs.append(f"{operation} {count} calls {errors} errors avg {int(total * 1000 / count)}ms max {int(longest * 1000)}ms")
+            return ', '.join(logs) if len(logs) > 0 else 'no calls'
+
+class GithubRateBudget:
+    """
+    The GitHub GraphQL rate limit points, shared by all threads, which is updated by the X-RateLimit-* headers and
+    the rateLimit field of queries, see with_rate_limit. Before the points are exhausted, the requests are paced
+    to spread the remaining points until the reset time when less than GITHUB_RATE_SLOWDOWN points, and paused
+    until the reset time when less than GITHUB_RATE_RESERVE points. The points spent are accounted to the item,
+    for example, the URL of issue, from begin_item to end_item.
+    """
+    def __init__(self, reserve, slowdown):
+        self.reserve_points = reserve
+        self.slowdown = slowdown
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.next_at = 0
+        self.spent = 0
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_seconds = 0
+        # The item, for example, the URL of issue, to the points spent, at most GITHUB_RATE_MAX_ITEMS items which
+        # are not ended, for example, the page prefetched after the item is ended.
+        self.items = collections.OrderedDict()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def begin_item(self, item):
+        """
+        Account the points of the requests in current thread to the item.
+        """
+        self.local.item = item
+
+    def end_item(self):
+        """
+        Stop accounting the item of current thread, and return the points spent by it.
+        """
+        item = self.current_item()
+        self.local.item = None
+        with self.lock:
+            return self.items.pop(item, 0)
+
+    def current_item(self):
+        return getattr(self.local, 'item', None)
+
+    def reserve(self):
+        """
+        Take a point from the remaining, and return the seconds to wait before sending the request.
+        """
+        with self.lock:
+            now = time.time()
+            if self.remaining is None or self.reset_at is None:
+                return 0
+            if self.reset_at <= now:
+                # The points are restored after the reset time, until next response.
+                (self.remaining, self.reset_at) = (None, None)
+                return 0
+            wait = 0
+            if self.remaining <= self.reserve_points:
+                wait = self.reset_at - now
+            elif self.remaining < self.slowdown:
+                self.next_at = max(now, self.next_at)
+                wait = self.next_at - now
+                self.next_at += (self.reset_at - now) / (self.remaining - self.reserve_points)
+            self.remaining -= 1
+            if wait > 0:
+                self.throttled += 1
+                self.throttled_seconds += wait
+            return wait
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait >= 1:
+            print(f"GitHub rate limited, wait {wait:.1f}s, remaining={self.remaining}/{self.limit}")
+        if wait > 0:
+            time.sleep(wait)
+
+    def update(self, status_code, headers, j_res):
+        """
+        Update the budget by the response, where the j_res is None if the request failed.
+        """
+        with self.lock:
+            self.requests += 1
+            if 'X-RateLimit-Remaining' in headers:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+                self.limit = int(headers.get('X-RateLimit-Limit', self.limit or 0))
+                self.reset_at = int(headers.get('X-RateLimit-Reset', time.time() + 3600))
+            # For secondary rate limit, see https://docs.github.com/en/rest/overview/rate-limits-for-the-rest-api
+            if status_code in [403, 429] and 'Retry-After' in headers:
+                self.remaining = 0
+                self.reset_at = time.time() + int(headers['Retry-After'])
+
+            # The cost of mutation is 1 point, see https://docs.github.com/en/graphql/overview/rate-limits-and-node-limits-for-the-graphql-api
+            cost = 1
+            if j_res is not None and j_res.get('data') is not None and j_res['data'].get('rateLimit') is not None:
+                cost = j_res['data']['rateLimit']['cost']
+            self.spent += cost
+            item = self.current_item()
+            if item is not None:
+                self.items[item] = self.items.get(item, 0) + cost
+                while len(self.items) > GITHUB_RATE_MAX_ITEMS:
+                    self.items.popitem(last=False)
+
+    def summary(self):
+        with self.lock:
+            logs = [f"spent {self.spent} points by {self.requests} requests"]
+            if self.remaining is not None:
+                logs.append(f"remaining {self.remaining}/{self.limit} reset in {max(0, int(self.reset_at - time.time()))}s")
+            if self.throttled > 0:
+                logs.append(f"throttled {self.throttled} times {self.throttled_seconds:.1f}s")
+            return ', '.join(logs)
+
+_github_rate_budget = None
+_github_rate_budget_lock = threading.Lock()
+def github_rate_budget():
+    global _github_rate_budget
+    with _github_rate_budget_lock:
+        if _github_rate_budget is None:
+            _github_rate_budget = GithubRateBudget(GITHUB_RATE_RESERVE, GITHUB_RATE_SLOWDOWN)
+        return _github_rate_budget
+
+def with_rate_limit(query):
+    """
+    Request the rateLimit of the query, to know the cost. Mutations don't support rateLimit.
+    """
+    if not query.lstrip().startswith('query') or 'rateLimit' in query:
+        return query
+    end = query.rindex('}')
+    return query[:end] + '  rateLimit { cost remaining resetAt limit }\n' + query[end:]
+
+def graphql_operation(query):
+    """
+    The first field of the query or mutation, for example, updateIssueComment.
+    """
+    matched = re.search(r'\{\s*(?:\w+\s*:\s*)?(\w+)', query)
+    return matched.group(1) if matched is not None else 'unknown'
+
+_github_graphql_client = None
+_github_graphql_client_lock = threading.Lock()
+def github_graphql_client():
+    global _github_graphql_client
+    with _github_graphql_client_lock:
+        if _github_graphql_client is None:
+            _github_graphql_client = GithubGraphQLClient(GITHUB_GRAPHQL_POOL_SIZE)
+        return _github_graphql_client
+
+def graphql(query, variables):
+    return github_graphql_client().request(query, variables)
+
+def iter_connection(connection, query, variables, path, complete=None):
+    """
+    Yield the nodes of a GraphQL connection, from the first page which is already queried, then follow the
+    pageInfo.endCursor by the query, with the variables and $after. While the caller is processing the nodes
+    of current page, the next page is fetched in background, and only two pages are kept in memory. The
+    complete(nodes) is called for each page before yielding, for example, to fetch the nested connections.
+    """
+    item = github_rate_budget().current_item()
+    def fetch(after):
+        github_rate_budget().begin_item(item)
+        page = query_connection(query, variables, path, after)
+        if complete is not None:
+            complete(page['nodes'])
+        return page
+
+    if complete is not None:
+        complete(connection['nodes'])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            future = None
+            if connection['pageInfo']['hasNextPage']:
+                future = executor.submit(fetch, connection['pageInfo']['endCursor'])
+            for node in connection['nodes']:
+                yield node
+            if future is None:
+                return
+            connection = future.result()
+
+def iter_pages(nodes, size=100):
+    """
+    Group the nodes from iter_connection to lists, to process a page of nodes at a time, for example, to
+    translate the short comments of a page in one request.
+    """
+    page = []
+    for node in nodes:
+        page.append(node)
+        if len(page) >= size:
+            yield page
+            page = []
+    if len(page) > 0:
+        yield page
+
+def query_connection(query, variables, path, after):
+    j_res = graphql(query, {**variables, "after": after})
+    return connection_at(j_res, path)
+
+def query_all_nodes(connection, query, variables, path):
+    """
+    Fetch all nodes of a nested connection, for example, the replies of a discussion comment.
+    """
+    nodes = list(connection['nodes'])
+    while connection['pageInfo']['hasNextPage']:
+        connection = query_connection(query, variables, path, connection['pageInfo']['endCursor'])
+        nodes.extend(connection['nodes'])
+    return nodes
+
+def connection_at(j_res, path):
+    j_res = j_res['data']
+    for key in path:
+        j_res = j_res[key]
+    return j_res
+
+def fix_ghost_authors(nodes):
+    # See https://github.com/ghost
+    for node in nodes:
+        if 'author' not in node or node['author'] is None:
+            node['author'] = {'login': 'ghost'}
+
 def query_repository_id(owner, name):
     query = '''
         query ($owner: String!, $name: String!) {
@@ -234,15 +1518,9 @@ def query_repository_id(owner, name):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "owner": owner, "name": name,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
     repository_id = j_res['data']['repository']['id']
     return repository_id
@@ -258,15 +1536,9 @@ def create_issue(repository_id, title, body):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "repositoryId": repository_id, "title": title, "body": body,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
     issue_id = j_res['data']['createIssue']['issue']['id']
     issue_url = j_res['data']['createIssue']['issue']['url']
@@ -283,72 +1555,92 @@ def create_discussion(repository_id, title, body, category_id):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "repositoryId": repository_id, "title": title, "body": body, "categoryId": category_id,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
     discussion_id = j_res['data']['createDiscussion']['discussion']['id']
     discussion_url = j_res['data']['createDiscussion']['discussion']['url']
     return (discussion_id, discussion_url)
 
-def query_issue(owner, name, issue_number):
-    query = '''
-        query ($owner: String!, $name: String!, $number: Int!) {
-          repository(name: $name, owner: $owner) {
-            issue(number: $number) {
+GRAPHQL_QUERY_ISSUE = '''
+    query ($owner: String!, $name: String!, $number: Int!) {
+      repository(name: $name, owner: $owner) {
+        issue(number: $number) {
+          id
+          title
+          body
+          labels(first: 100) {
+            totalCount
+            nodes {
               id
-              title
-              body
-              labels(first: 100) {
-                totalCount
-                nodes {
-                  id
-                  name
-                }
+              name
+            }
+          }
+          comments(first: 100) {
+            totalCount
+            nodes {
+              id
+              author {
+                login
               }
-              comments(first: 100) {
-                totalCount
-                nodes {
-                  id
-                  author {
-                    login
-                  }
-                  url
-                  body
-                }
+              url
+              body
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+        }
+      }
+    }
+'''
+
+GRAPHQL_QUERY_ISSUE_COMMENTS = '''
+    query ($owner: String!, $name: String!, $number: Int!, $after: String) {
+      repository(name: $name, owner: $owner) {
+        issue(number: $number) {
+          comments(first: 100, after: $after) {
+            totalCount
+            nodes {
+              id
+              author {
+                login
               }
+              url
+              body
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
             }
           }
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "owner": owner, "name": name, "number": issue_number,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
+      }
+    }
+'''
+
+def query_issue(owner, name, issue_number):
+    """
+    Query the issue, where the comments is a generator, which fetches the next page in background while the
+    caller is processing the current page.
+    """
+    variables = {"owner": owner, "name": name, "number": issue_number}
+    j_res = graphql(GRAPHQL_QUERY_ISSUE, variables)
 
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    issue = parse_query_issue(j_res)
+    issue['comments'] = iter_connection(j_res['data']['repository']['issue']['comments'],
+        GRAPHQL_QUERY_ISSUE_COMMENTS, variables, ['repository', 'issue', 'comments'], fix_ghost_authors)
+    return issue
 
+def parse_query_issue(j_res):
     total_labels = j_res['data']['repository']['issue']['labels']['totalCount']
     if total_labels > 100:
         raise Exception(f"too many labels, count={total_labels} {j_res}")
 
-    total_comments = j_res['data']['repository']['issue']['comments']['totalCount']
-    if total_comments > 100:
-        raise Exception(f"too many comments, count={total_comments} {j_res}")
-
-    # See https://github.com/ghost
-    for c in j_res['data']['repository']['issue']['comments']['nodes']:
-        if 'author' not in c or c['author'] is None:
-            c['author'] = {'login': 'ghost'}
+    # Only the first page of comments, see query_issue for all comments.
+    fix_ghost_authors(j_res['data']['repository']['issue']['comments']['nodes'])
 
     return {
         'id': j_res['data']['repository']['issue']['id'],
@@ -358,51 +1650,47 @@ def query_issue(owner, name, issue_number):
         "comments": j_res['data']['repository']['issue']['comments']['nodes'],
     }
 
-def update_issue_comment(id, body):
-    query = '''
-        mutation ($id: ID!, $body:String!) {
-          updateIssueComment(input: {id: $id, body: $body}) {
-            issueComment {
-              id
-            }
-          }
+GRAPHQL_UPDATE_ISSUE_COMMENT = '''
+    mutation ($id: ID!, $body:String!) {
+      updateIssueComment(input: {id: $id, body: $body}) {
+        issueComment {
+          id
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "id": id, "body": body,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
+      }
+    }
+'''
 
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+def update_issue_comment(id, body):
+    j_res = graphql(GRAPHQL_UPDATE_ISSUE_COMMENT, {
+        "id": id, "body": body,
+    })
 
     return j_res['data']['updateIssueComment']['issueComment']['id']
 
-def update_issue(id, title, body):
-    query = '''
-        mutation ($id: ID!, $title:String!, $body: String!) {
-          updateIssue(input: {id: $id, body: $body, title: $title}) {
-            issue {
-              id
-            }
-          }
+GRAPHQL_UPDATE_ISSUE = '''
+    mutation ($id: ID!, $title:String!, $body: String!) {
+      updateIssue(input: {id: $id, body: $body, title: $title}) {
+        issue {
+          id
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "id": id, "title": title, "body": body,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
+      }
+    }
+'''
 
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+def update_issue(id, title, body):
+    j_res = graphql(GRAPHQL_UPDATE_ISSUE, {
+        "id": id, "title": title, "body": body,
+    })
 
     return j_res['data']['updateIssue']['issue']['id']
 
 def query_label_id(owner, name, label):
+    """
+    Query the id of label in repository, from the GitHub id cache if possible.
+    """
+    return github_id_cache().get_or_query('label', owner, name, label, do_query_label_id)
+
+def do_query_label_id(owner, name, label):
     query = '''
         query($name: String!, $owner: String!, $label: String!) {
           repository(name: $name, owner: $owner) {
@@ -412,20 +1700,22 @@ def query_label_id(owner, name, label):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "name": name, "owner": owner, "label": label
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
+    if j_res['data']['repository']['label'] is None:
+        raise Exception(f"label {label} not found in {owner}/{name}")
     id = j_res['data']['repository']['label']['id']
     return id
 
 def query_catetory_id(owner, name, category_slug):
+    """
+    Query the id of discussion category in repository, from the GitHub id cache if possible.
+    """
+    return github_id_cache().get_or_query('category', owner, name, category_slug, do_query_catetory_id)
+
+def do_query_catetory_id(owner, name, category_slug):
     query = '''
         query ($name:String!, $owner: String!, $slug: String!) {
           repository(name: $name, owner: $owner) {
@@ -435,20 +1725,19 @@ def query_catetory_id(owner, name, category_slug):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "name": name, "owner": owner, "slug": category_slug
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
+    if j_res['data']['repository']['discussionCategory'] is None:
+        raise Exception(f"category {category_slug} not found in {owner}/{name}")
     id = j_res['data']['repository']['discussionCategory']['id']
     return id
 
 def add_label(owner_id, label_id):
+    return add_labels(owner_id, [label_id])
+
+def add_labels(owner_id, label_ids):
     query = '''
         mutation ($id: ID!, $labelIds: [ID!]!) {
           addLabelsToLabelable(
@@ -462,35 +1751,165 @@ def add_label(owner_id, label_id):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "id": owner_id, "labelIds": [label_id]
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    j_res = graphql(query, {
+        "id": owner_id, "labelIds": label_ids
+    })
 
     return j_res['data']['addLabelsToLabelable']['labelable']['labels']['totalCount']
 
-def query_discussion(owner, name, discussion_number):
-    query = '''
-        query($name: String!, $owner: String!, $number: Int!) {
-          repository(name: $name, owner: $owner) {
-            discussion(number: $number) {
+def add_labels_by_name(owner, name, owner_id, labels):
+    """
+    Add the labels by name to the issue, PR or discussion in one request, and return the label ids. If a cached
+    label id is not found, for example, the label is deleted and created again, query the ids and retry once.
+    """
+    label_ids = [query_label_id(owner, name, label) for label in labels]
+    try:
+        add_labels(owner_id, label_ids)
+    except GithubGraphQLException as e:
+        if not e.is_not_found():
+            raise e
+        print(f"Warning!!! Invalidate label ids {labels} of {owner}/{name} for not found, {e.errors}")
+        for label in labels:
+            github_id_cache().invalidate('label', owner, name, label)
+        label_ids = [query_label_id(owner, name, label) for label in labels]
+        add_labels(owner_id, label_ids)
+    return label_ids
+
+class GithubIdCache:
+    """
+    The cache of GitHub node ids which never change, like labels and discussion categories, keyed by the kind,
+    repository and name, expired in GITHUB_ID_CACHE_MAX_AGE seconds. It's stored in a table of the translation
+    cache file, or in memory if the file is disabled, so it's shared by all scripts.
+    """
+    def __init__(self, filename, max_age):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS github_ids (
+                kind TEXT NOT NULL,
+                repository TEXT NOT NULL,
+                name TEXT NOT NULL,
+                id TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (kind, repository, name)
+            )
+        ''')
+        self.db.execute("DELETE FROM github_ids WHERE created_at < ?", (time.time() - self.max_age,))
+        self.db.commit()
+
+    def get(self, kind, owner, name, key):
+        with self.lock:
+            row = self.db.execute("SELECT id, created_at FROM github_ids WHERE kind=? AND repository=? AND name=?", (
+                kind, f"{owner}/{name}", key,
+            )).fetchone()
+            if row is None or time.time() - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, kind, owner, name, key, id):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO github_ids VALUES (?, ?, ?, ?, ?)", (
+                kind, f"{owner}/{name}", key, id, time.time(),
+            ))
+            self.db.commit()
+
+    def invalidate(self, kind, owner, name, key):
+        with self.lock:
+            self.db.execute("DELETE FROM github_ids WHERE kind=? AND repository=? AND name=?", (
+                kind, f"{owner}/{name}", key,
+            ))
+            self.db.commit()
+
+    def get_or_query(self, kind, owner, name, key, query):
+        id = self.get(kind, owner, name, key)
+        if id is None:
+            id = query(owner, name, key)
+            self.put(kind, owner, name, key, id)
+            print(f"Query {kind} {key} of {owner}/{name}, got id={id}")
+        return id
+
+    def summary(self):
+        return f"hits={self.hits}, misses={self.misses}"
+
+_github_id_cache = None
+_github_id_cache_lock = threading.Lock()
+def github_id_cache():
+    global _github_id_cache
+    with _github_id_cache_lock:
+        if _github_id_cache is None:
+            filename = TRANS_CACHE_FILE if TRANS_CACHE_FILE is not None and TRANS_CACHE_FILE != '' else ':memory:'
+            _github_id_cache = GithubIdCache(filename, GITHUB_ID_CACHE_MAX_AGE)
+        return _github_id_cache
+
+GRAPHQL_QUERY_DISCUSSION = '''
+    query($name: String!, $owner: String!, $number: Int!) {
+      repository(name: $name, owner: $owner) {
+        discussion(number: $number) {
+          id
+          body
+          title
+          number
+          labels(first: 100) {
+            totalCount
+            nodes {
+              id
+              name
+            }
+          }
+          comments(first: 100) {
+            totalCount
+            nodes {
               id
+              author {
+                login
+              }
+              url
               body
-              title
-              number
-              labels(first: 100) {
+              replies(first: 100) {
                 totalCount
                 nodes {
                   id
-                  name
+                  author {
+                    login
+                  }
+                  url
+                  body
+                }
+                pageInfo {
+                  endCursor
+                  hasNextPage
                 }
               }
-              comments(first: 100) {
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+        }
+      }
+    }
+'''
+
+GRAPHQL_QUERY_DISCUSSION_COMMENTS = '''
+    query($name: String!, $owner: String!, $number: Int!, $after: String) {
+      repository(name: $name, owner: $owner) {
+        discussion(number: $number) {
+          comments(first: 100, after: $after) {
+            totalCount
+            nodes {
+              id
+              author {
+                login
+              }
+              url
+              body
+              replies(first: 100) {
                 totalCount
                 nodes {
                   id
@@ -499,62 +1918,77 @@ def query_discussion(owner, name, discussion_number):
                   }
                   url
                   body
-                  replies(first: 100) {
-                    totalCount
-                    nodes {
-                      id
-                      author {
-                        login
-                      }
-                      url
-                      body
-                    }
-                    pageInfo {
-                      endCursor
-                      startCursor
-                    }
-                  }
                 }
                 pageInfo {
                   endCursor
-                  startCursor
+                  hasNextPage
                 }
               }
             }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
           }
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "name": name, "owner": owner, "number": discussion_number
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
-
-    totalCount = j_res['data']['repository']['discussion']['comments']['totalCount']
-    if totalCount > 100:
-        raise Exception(f"comments.totalCount > 100, {totalCount} of {j_res}")
+      }
+    }
+'''
+
+GRAPHQL_QUERY_DISCUSSION_REPLIES = '''
+    query($id: ID!, $after: String) {
+      node(id: $id) {
+        ... on DiscussionComment {
+          replies(first: 100, after: $after) {
+            totalCount
+            nodes {
+              id
+              author {
+                login
+              }
+              url
+              body
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+        }
+      }
+    }
+'''
 
+def query_discussion(owner, name, discussion_number):
+    """
+    Query the discussion, where the comments is a generator like query_issue. The replies of each comment are
+    always a list, which is completed before the comment is yielded.
+    """
+    variables = {"name": name, "owner": owner, "number": discussion_number}
+    j_res = graphql(GRAPHQL_QUERY_DISCUSSION, variables)
+
+    discussion = parse_query_discussion(j_res)
+    discussion['comments'] = iter_connection(j_res['data']['repository']['discussion']['comments'],
+        GRAPHQL_QUERY_DISCUSSION_COMMENTS, variables, ['repository', 'discussion', 'comments'],
+        complete_discussion_comments)
+    return discussion
+
+def complete_discussion_comments(comments):
+    fix_ghost_authors(comments)
+    for c in comments:
+        if c['replies']['pageInfo']['hasNextPage']:
+            c['replies']['nodes'] = query_all_nodes(c['replies'], GRAPHQL_QUERY_DISCUSSION_REPLIES,
+                {"id": c['id']}, ['node', 'replies'])
+        fix_ghost_authors(c['replies']['nodes'])
+
+def parse_query_discussion(j_res):
     totalCount = j_res['data']['repository']['discussion']["labels"]['totalCount']
     if totalCount > 100:
         raise Exception(f"labels.totalCount > 100, {totalCount} of {j_res}")
 
-    j_nodes = j_res['data']['repository']['discussion']['comments']['nodes']
-    for index, j_node in enumerate(j_nodes):
-        totalCount = j_node["replies"]["totalCount"]
-        if totalCount > 100:
-            raise Exception(f"comments[{index}].replies.totalCount > 100, {totalCount} of {j_node}")
-
-    # See https://github.com/ghost
+    # Only the first page of comments and replies, see query_discussion for all comments.
     for c in j_res['data']['repository']['discussion']['comments']['nodes']:
-        if 'author' not in c or c['author'] is None:
-            c['author'] = {'login': 'ghost'}
-        for r in c['replies']['nodes']:
-            if r['author'] is None:
-                r['author'] = {'login': 'ghost'}
+        fix_ghost_authors([c] + c['replies']['nodes'])
 
     return {
         "id": j_res['data']['repository']['discussion']['id'],
@@ -564,57 +1998,45 @@ def query_discussion(owner, name, discussion_number):
         "comments": j_res['data']['repository']['discussion']['comments']['nodes'],
     }
 
-def update_discussion_comment(id, body):
-    query = '''
-        mutation ($id: ID!, $body: String!) {
-          updateDiscussionComment(
-            input: {commentId: $id, body: $body}
-          ) {
-            comment {
-              id
-            }
-          }
+GRAPHQL_UPDATE_DISCUSSION_COMMENT = '''
+    mutation ($id: ID!, $body: String!) {
+      updateDiscussionComment(
+        input: {commentId: $id, body: $body}
+      ) {
+        comment {
+          id
         }
-    '''
+      }
+    }
+'''
+
+def update_discussion_comment(id, body):
     variables = {
         "id": id,
         'body': body,
     }
-    res = requests.post('https://api.github.com/graphql', json={
-        "query": query, "variables": variables
-    }, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    j_res = graphql(GRAPHQL_UPDATE_DISCUSSION_COMMENT, variables)
 
     return j_res['data']['updateDiscussionComment']['comment']['id']
 
-def update_discussion(id, title, body):
-    query = '''
-        mutation ($id: ID!, $title: String!, $body: String!) {
-          updateDiscussion(
-            input: {discussionId: $id, title: $title, body: $body}
-          ) {
-            discussion {
-              id
-            }
-          }
+GRAPHQL_UPDATE_DISCUSSION = '''
+    mutation ($id: ID!, $title: String!, $body: String!) {
+      updateDiscussion(
+        input: {discussionId: $id, title: $title, body: $body}
+      ) {
+        discussion {
+          id
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+      }
+    }
+'''
+
+def update_discussion(id, title, body):
+    j_res = graphql(GRAPHQL_UPDATE_DISCUSSION, {
         "id": id,
         "title": title,
         'body': body,
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
     return j_res['data']['updateDiscussion']['discussion']['id']
 
@@ -667,15 +2089,9 @@ def search_issues(owner, name, isf, sort, labels, count):
     if 'discussion' in isf:
         search_type = 'DISCUSSION'
     filter = f"repo:{owner}/{name} {isf} {sort} {' '.join(labels)}"
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "query": filter, "type": search_type, "first": count
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
     return j_res['data']['search']['nodes']
 
@@ -726,15 +2142,9 @@ def query_pullrequest(owner, name, pr_number):
           }
         }
     '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
+    j_res = graphql(query, {
         "name": name, "owner": owner, "number": pr_number
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    })
 
     total_labels = j_res['data']['repository']['pullRequest']['labels']['totalCount']
     if total_labels > 100:
@@ -761,21 +2171,38 @@ def query_pullrequest(owner, name, pr_number):
         "labels": j_res['data']['repository']['pullRequest']["labels"]["nodes"],
     }
 
-def query_pullrequest_all_in_one(owner, name, pr_number):
-    query = '''
-        query ($name: String!, $owner: String!, $number: Int!) {
-          repository(name: $name, owner: $owner) {
-            pullRequest(number: $number) {
+GRAPHQL_QUERY_PULLREQUEST_ALL_IN_ONE = '''
+    query ($name: String!, $owner: String!, $number: Int!) {
+      repository(name: $name, owner: $owner) {
+        pullRequest(number: $number) {
+          id
+          title
+          body
+          labels(first: 100) {
+            totalCount
+            nodes {
               id
-              title
+              name
+            }
+          }
+          comments(first: 100) {
+            totalCount
+            nodes {
+              id
+              url
+              body
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+          reviews(first: 100) {
+            totalCount
+            nodes {
+              id
+              url
               body
-              labels(first: 100) {
-                totalCount
-                nodes {
-                  id
-                  name
-                }
-              }
               comments(first: 100) {
                 totalCount
                 nodes {
@@ -783,55 +2210,125 @@ def query_pullrequest_all_in_one(owner, name, pr_number):
                   url
                   body
                 }
+                pageInfo {
+                  endCursor
+                  hasNextPage
+                }
               }
-              reviews(first: 100) {
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+        }
+      }
+    }
+'''
+
+GRAPHQL_QUERY_PULLREQUEST_COMMENTS = '''
+    query ($name: String!, $owner: String!, $number: Int!, $after: String) {
+      repository(name: $name, owner: $owner) {
+        pullRequest(number: $number) {
+          comments(first: 100, after: $after) {
+            totalCount
+            nodes {
+              id
+              url
+              body
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+        }
+      }
+    }
+'''
+
+GRAPHQL_QUERY_PULLREQUEST_REVIEWS = '''
+    query ($name: String!, $owner: String!, $number: Int!, $after: String) {
+      repository(name: $name, owner: $owner) {
+        pullRequest(number: $number) {
+          reviews(first: 100, after: $after) {
+            totalCount
+            nodes {
+              id
+              url
+              body
+              comments(first: 100) {
                 totalCount
                 nodes {
                   id
                   url
                   body
-                  comments(first: 100) {
-                    totalCount
-                    nodes {
-                      id
-                      url
-                      body
-                    }
-                  }
+                }
+                pageInfo {
+                  endCursor
+                  hasNextPage
                 }
               }
             }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
           }
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "name": name, "owner": owner, "number": pr_number
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+      }
+    }
+'''
+
+GRAPHQL_QUERY_PULLREQUEST_REVIEW_COMMENTS = '''
+    query ($id: ID!, $after: String) {
+      node(id: $id) {
+        ... on PullRequestReview {
+          comments(first: 100, after: $after) {
+            totalCount
+            nodes {
+              id
+              url
+              body
+            }
+            pageInfo {
+              endCursor
+              hasNextPage
+            }
+          }
+        }
+      }
+    }
+'''
 
+def query_pullrequest_all_in_one(owner, name, pr_number):
+    """
+    Query the PR, where the comments and reviews are generators like query_issue. The comments of each review
+    are always a list, which is completed before the review is yielded.
+    """
+    variables = {"name": name, "owner": owner, "number": pr_number}
+    j_res = graphql(GRAPHQL_QUERY_PULLREQUEST_ALL_IN_ONE, variables)
+
+    pr = parse_query_pullrequest_all_in_one(j_res)
+    pr['comments'] = iter_connection(j_res['data']['repository']['pullRequest']['comments'],
+        GRAPHQL_QUERY_PULLREQUEST_COMMENTS, variables, ['repository', 'pullRequest', 'comments'])
+    pr['reviews'] = iter_connection(j_res['data']['repository']['pullRequest']['reviews'],
+        GRAPHQL_QUERY_PULLREQUEST_REVIEWS, variables, ['repository', 'pullRequest', 'reviews'],
+        complete_pullrequest_reviews)
+    return pr
+
+def complete_pullrequest_reviews(reviews):
+    for review in reviews:
+        if review['comments']['pageInfo']['hasNextPage']:
+            review['comments']['nodes'] = query_all_nodes(review['comments'], GRAPHQL_QUERY_PULLREQUEST_REVIEW_COMMENTS,
+                {"id": review['id']}, ['node', 'comments'])
+
+def parse_query_pullrequest_all_in_one(j_res):
     total_labels = j_res['data']['repository']['pullRequest']['labels']['totalCount']
     if total_labels > 100:
         raise Exception(f"too many labels, count={total_labels} {j_res}")
 
-    total_comments = j_res['data']['repository']['pullRequest']['comments']['totalCount']
-    if total_comments > 100:
-        raise Exception(f"too many comments, count={total_comments} {j_res}")
-
-    total_reviews = j_res['data']['repository']['pullRequest']['reviews']['totalCount']
-    if total_reviews > 100:
-        raise Exception(f"too many reviews, count={total_reviews} {j_res}")
-
-    reviews = []
-    for review in j_res['data']['repository']['pullRequest']['reviews']['nodes']:
-        total_review_comments = review['comments']['totalCount']
-        if total_review_comments > 100:
-            raise Exception(f"too many review comments, count={total_review_comments} {j_res}")
-
+    # Only the first page of comments and reviews, see query_pullrequest_all_in_one for all of them.
     return {
         "id": j_res['data']['repository']['pullRequest']['id'],
         "title": j_res['data']['repository']['pullRequest']['title'],
@@ -841,82 +2338,695 @@ def query_pullrequest_all_in_one(owner, name, pr_number):
         "reviews": j_res['data']['repository']['pullRequest']['reviews']['nodes'],
     }
 
-def update_pullrequest(id, title, body):
-    query = '''
-        mutation ($id: ID!, $title: String!, $body: String!) {
-          updatePullRequest(
-            input: {pullRequestId: $id, title: $title, body: $body}
-          ) {
-            pullRequest {
-              id
-            }
-          }
+GRAPHQL_UPDATE_PULLREQUEST = '''
+    mutation ($id: ID!, $title: String!, $body: String!) {
+      updatePullRequest(
+        input: {pullRequestId: $id, title: $title, body: $body}
+      ) {
+        pullRequest {
+          id
         }
-    '''
-    res = requests.post('https://api.github.com/graphql', json={"query": query, "variables": {
-        "id": id, "title": title, "body": body
-    }}, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
+      }
+    }
+'''
 
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+def update_pullrequest(id, title, body):
+    j_res = graphql(GRAPHQL_UPDATE_PULLREQUEST, {
+        "id": id, "title": title, "body": body
+    })
 
     return j_res['data']['updatePullRequest']['pullRequest']['id']
 
-def update_pullrequest_review(id, body):
-    query = '''
-        mutation ($id: ID!, $body: String!) {
-          updatePullRequestReview(
-            input: {pullRequestReviewId: $id, body: $body}
-          ) {
-            pullRequestReview {
-              id
-            }
-          }
+GRAPHQL_UPDATE_PULLREQUEST_REVIEW = '''
+    mutation ($id: ID!, $body: String!) {
+      updatePullRequestReview(
+        input: {pullRequestReviewId: $id, body: $body}
+      ) {
+        pullRequestReview {
+          id
         }
-    '''
+      }
+    }
+'''
+
+def update_pullrequest_review(id, body):
     variables = {
         "id": id,
         'body': body,
     }
-    res = requests.post('https://api.github.com/graphql', json={
-        "query": query, "variables": variables
-    }, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    j_res = graphql(GRAPHQL_UPDATE_PULLREQUEST_REVIEW, variables)
 
     return j_res['data']['updatePullRequestReview']['pullRequestReview']['id']
 
-def update_pullrequest_review_comment(id, body):
-    query = '''
-        mutation ($id: ID!, $body: String!) {
-          updatePullRequestReviewComment(
-            input: {pullRequestReviewCommentId: $id, body: $body}
-          ) {
-            pullRequestReviewComment {
-              id
-            }
-          }
+GRAPHQL_UPDATE_PULLREQUEST_REVIEW_COMMENT = '''
+    mutation ($id: ID!, $body: String!) {
+      updatePullRequestReviewComment(
+        input: {pullRequestReviewCommentId: $id, body: $body}
+      ) {
+        pullRequestReviewComment {
+          id
         }
-    '''
+      }
+    }
+'''
+
+def update_pullrequest_review_comment(id, body):
     variables = {
         "id": id,
         'body': body,
     }
-    res = requests.post('https://api.github.com/graphql', json={
-        "query": query, "variables": variables
-    }, headers=get_graphql_headers())
-    if res.status_code != 200:
-        raise Exception(f"request failed, code={res.status_code}")
-
-    j_res = res.json()
-    if 'errors' in j_res:
-        raise GithubGraphQLException(f"request failed, {j_res}", res)
+    j_res = graphql(GRAPHQL_UPDATE_PULLREQUEST_REVIEW_COMMENT, variables)
 
     return j_res['data']['updatePullRequestReviewComment']['pullRequestReviewComment']['id']
+
+# The mutations which are able to be batched, the name of the id in input, and the object in payload.
+GRAPHQL_BATCH_MUTATIONS = {
+    'updateIssueComment': ('id', 'issueComment'),
+    'updateDiscussionComment': ('commentId', 'comment'),
+    'updatePullRequestReview': ('pullRequestReviewId', 'pullRequestReview'),
+    'updatePullRequestReviewComment': ('pullRequestReviewCommentId', 'pullRequestReviewComment'),
+}
+
+class GraphQLMutation:
+    def __init__(self, operation, id, body):
+        self.operation = operation
+        self.id = id
+        self.body = body
+        # The id in response if ok, or the GithubGraphQLException of this mutation if failed.
+        self.result = None
+        self.error = None
+
+class GraphQLMutationBatch:
+    """
+    Collect the comment updates, and send them as one aliased GraphQL document, for example:
+        mutation ($id1: ID!, $body1: String!, $id2: ID!, $body2: String!) {
+          c1: updateIssueComment(input: {id: $id1, body: $body1}) { issueComment { id } }
+          c2: updateDiscussionComment(input: {commentId: $id2, body: $body2}) { comment { id } }
+        }
+    The errors are mapped to each mutation by the alias in error path, so a forbidden comment doesn't fail
+    the others in the same document.
+    """
+    def __init__(self, batch_size=None):
+        self.batch_size = max(1, batch_size if batch_size is not None else GITHUB_MUTATION_BATCH_SIZE)
+        self.pending = []
+        self.completed = []
+
+    def add(self, operation, id, body):
+        if operation not in GRAPHQL_BATCH_MUTATIONS:
+            raise Exception(f"mutation {operation} is not able to be batched")
+        mutation = GraphQLMutation(operation, id, body)
+        self.pending.append(mutation)
+        if len(self.pending) >= self.batch_size:
+            self.send(self.pending)
+            self.pending = []
+        return mutation
+
+    def flush(self):
+        """
+        Send the pending mutations, and return all the mutations completed since the last flush.
+        """
+        if len(self.pending) > 0:
+            self.send(self.pending)
+            self.pending = []
+        (completed, self.completed) = (self.completed, [])
+        return completed
+
+    def send(self, mutations):
+        (query, variables) = batch_mutations_document(mutations)
+        print(f"Send {len(mutations)} mutations in one request, {len(query)}B")
+        (res, errors) = (None, [])
+        try:
+            j_res = graphql(query, variables)
+        except GithubGraphQLException as e:
+            (j_res, res) = (e.json, e.res)
+            errors = e.errors if e.errors is not None else []
+            # Fail all mutations if the whole document is failed, for example, HTTP error or syntax error.
+            if j_res.get('data') is None or len([error for error in errors if len(error.get('path', [])) == 0]) > 0:
+                for mutation in mutations:
+                    mutation.error = e
+                self.completed.extend(mutations)
+                return
+
+        for (index, mutation) in enumerate(mutations):
+            alias = f"c{index + 1}"
+            alias_errors = [error for error in errors if error.get('path', [None])[0] == alias]
+            if len(alias_errors) > 0:
+                mutation.error = GithubGraphQLException(f"request failed, {alias_errors}", res)
+                mutation.error.errors = alias_errors
+            elif j_res['data'].get(alias) is None:
+                # Only for partial failure, because GitHub responses the data of all aliases if no error.
+                mutation.error = GithubGraphQLException(f"request failed, no data for {alias}", res)
+            else:
+                (_, payload) = GRAPHQL_BATCH_MUTATIONS[mutation.operation]
+                mutation.result = j_res['data'][alias][payload]['id']
+        self.completed.extend(mutations)
+
+def batch_mutations_document(mutations):
+    args = []
+    fields = []
+    variables = {}
+    for (index, mutation) in enumerate(mutations):
+        (input_id, payload) = GRAPHQL_BATCH_MUTATIONS[mutation.operation]
+        n = index + 1
+        args.append(f"$id{n}: ID!, $body{n}: String!")
+        fields.append(f"c{n}: {mutation.operation}(input: {{{input_id}: $id{n}, body: $body{n}}}) {{ {payload} {{ id }} }}")
+        variables[f"id{n}"] = mutation.id
+        variables[f"body{n}"] = mutation.body
+    query = "mutation (" + ", ".join(args) + ") {\n  " + "\n  ".join(fields) + "\n}"
+    return (query, variables)
+
+################################################################################
+# The translation flows of issue, discussion and PR, used by the scripts, server and batch in the same process.
+################################################################################
+
+def parse_webhook_item(j_item):
+    """
+    Build the item like query_issue from the issue, discussion or pull_request object of webhook payload, for
+    the issues.opened, discussion.created and pull_request.opened events, to skip the query. Return None if any
+    data is missing, or there are comments already, to query it by GraphQL. The reviews are always empty, for
+    the reviews submitted later are translated by the pull_request_review events.
+    """
+    for key in ['node_id', 'title', 'labels']:
+        if j_item.get(key) is None:
+            return None
+    if 'body' not in j_item:
+        return None
+    if j_item.get('comments') != 0 or j_item.get('review_comments', 0) != 0:
+        return None
+
+    return {
+        "id": j_item['node_id'],
+        "title": j_item['title'],
+        # The body is null in payload if it's empty, but empty string in GraphQL.
+        "body": j_item['body'] if j_item['body'] is not None else '',
+        "labels": [{"id": label['node_id'], "name": label['name']} for label in j_item['labels']],
+        "comments": [],
+        "reviews": [],
+    }
+
+def trans_issue(url, seed=None, skip=()):
+    """
+    Translate the title, body and comments of the issue by url, for example, https://github.com/ossrs/srs/issues/3692
+    then update them and add the labels. Return the translated title and body, and whether they are changed by
+    the translation, to forward the webhook event.
+    The seed is the issue built from webhook payload by parse_webhook_item, or None to query it.
+    The comments whose node id is in skip are left as is, because they're translated by their own events.
+    """
+    issue = parse_issue_url(url)
+    if seed is not None:
+        print(f"Use the issue from webhook payload, skip query")
+        j_issue_res = seed
+    else:
+        j_issue_res = query_issue(issue["owner"], issue["name"], issue["number"])
+
+    # Process the comments page by page, while the next page is fetching, so a long thread never loads at once.
+    comment_trans_by_gpt = False
+    batch = GraphQLMutationBatch()
+    offset = 0
+    for comments in iter_pages(j_issue_res['comments']):
+        comments_to_trans = [j_res_c for j_res_c in comments if j_res_c["id"] not in skip]
+        comments_trans = gpt_translate_many([j_res_c["body"] for j_res_c in comments_to_trans], False)
+        comments_trans = dict(zip([j_res_c["id"] for j_res_c in comments_to_trans], comments_trans))
+        for index, j_res_c in enumerate(comments, offset):
+            c_id = j_res_c["id"]
+            c_author = j_res_c["author"]["login"]
+            c_url = j_res_c["url"]
+            c_body = j_res_c["body"]
+            print("")
+            print(f"===============Comment(#{index+1})===============")
+            print(f"ID: {c_id}")
+            print(f"Author: {c_author}")
+            print(f"URL: {c_url}")
+            print(f"Body:\n{c_body}\n")
+
+            if c_id in skip:
+                print(f"Translated by the comment event, skip")
+                continue
+
+            print(f"Updating......")
+            (c_body_trans, trans_by_gpt, real_translated) = comments_trans[c_id]
+            comment_trans_by_gpt = comment_trans_by_gpt or trans_by_gpt
+            if real_translated:
+                print(f"Body:\n{c_body_trans}\n")
+                batch.add('updateIssueComment', c_id, wrap_magic(c_body_trans))
+                print(f"Queued update")
+
+        flush_comment_updates(batch)
+        offset += len(comments)
+
+    id = j_issue_res["id"]
+    title = j_issue_res["title"]
+    body = j_issue_res["body"]
+
+    has_gpt_label = False
+    has_en_native_label = False
+    labels4print=[]
+    for label in j_issue_res["labels"]:
+        if label["name"] == LABEL_TRANS_NAME:
+            has_gpt_label = True
+        if label["name"] == LABEL_ENGLISH_NATIVE:
+            has_en_native_label = True
+        labels4print.append(f"{label['id']}({label['name']})")
+    print("")
+    print(f"===============ISSUE===============")
+    print(f"ID: {id}")
+    print(f"Url: {url}")
+    print(f"Title: {title}")
+    print(f"Labels: {', '.join(labels4print)}")
+    print(f"Body:\n{body}\n")
+
+    print(f"Updating......")
+    issue_changed = False
+    issue_trans_by_gpt = False
+    title_trans = title
+    body_trans = body
+    if already_english(title):
+        print(f"Title is already english, skip")
+    else:
+        (title_trans, trans_by_gpt, real_translated) = gpt_translate(title, issue_trans_by_gpt)
+        if trans_by_gpt:
+            issue_trans_by_gpt = True
+        if real_translated:
+            issue_changed = True
+            print(f"Title: {title_trans}")
+
+    if TRANS_MAGIC in body:
+        issue_trans_by_gpt = True
+        print(f"Body is already translated, skip")
+    elif already_english(body):
+        print(f"Body is already english, skip")
+    else:
+        (body_trans, trans_by_gpt, real_translated) = gpt_translate(body, issue_trans_by_gpt)
+        if trans_by_gpt:
+            issue_trans_by_gpt = True
+        if real_translated:
+            issue_changed = True
+            print(f"Body:\n{body_trans}\n")
+
+    if not issue_changed:
+        print(f"Nothing changed, skip")
+    else:
+        try:
+            update_issue(id, title_trans, wrap_magic(body_trans))
+            print(f"Updated ok")
+        except GithubGraphQLException as e:
+            if e.is_forbidden():
+                print(f"Warning!!! Ignore update issue {id} failed, forbidden, {e.errors}")
+            else:
+                raise e
+
+    any_by_gpt = comment_trans_by_gpt or issue_trans_by_gpt
+    labels = []
+    if not any_by_gpt or has_gpt_label:
+        print(f"Label is already set, skip")
+    else:
+        labels.append(LABEL_TRANS_NAME)
+
+    if not any_by_gpt and not has_gpt_label and not has_en_native_label:
+        labels.append(LABEL_ENGLISH_NATIVE)
+
+    if len(labels) > 0:
+        print(f"Add labels {', '.join(labels)}")
+        label_ids = add_labels_by_name(issue["owner"], issue["name"], id, labels)
+        print(f"Add labels ok, {', '.join(label_ids)}")
+
+    return {
+        "id": id,
+        "title": title_trans,
+        "body": wrap_magic(body_trans) if issue_changed else body,
+        "changed": issue_changed,
+    }
+
+def trans_discussion(url, seed=None, skip=()):
+    """
+    Translate the title, body and comments of the discussion by url, for example, https://github.com/ossrs/srs/discussions/3700
+    then update them and add the labels. Return the translated title and body, and whether they are changed by
+    the translation, to forward the webhook event.
+    The seed is the discussion built from webhook payload by parse_webhook_item, or None to query it.
+    The comments whose node id is in skip are left as is, because they're translated by their own events.
+    """
+    discussion = parse_discussion_url(url)
+    if seed is not None:
+        print(f"Use the discussion from webhook payload, skip query")
+        j_discussion_res = seed
+    else:
+        j_discussion_res = query_discussion(discussion["owner"], discussion["name"], discussion["number"])
+
+    # Process the comments page by page, while the next page is fetching, so a long thread never loads at once.
+    comment_trans_by_gpt = False
+    batch = GraphQLMutationBatch()
+    offset = 0
+    for j_res in iter_pages(j_discussion_res['comments']):
+        # Translate the comments and replies of a page together, so the short ones can be packed into one request.
+        nodes_to_trans = []
+        for j_res_c in j_res:
+            for node in [j_res_c] + j_res_c["replies"]["nodes"]:
+                if node["id"] not in skip and TRANS_MAGIC not in node["body"] and not already_english(node["body"]):
+                    nodes_to_trans.append(node)
+        nodes_trans = gpt_translate_many([node["body"] for node in nodes_to_trans], False)
+        nodes_trans = dict(zip([node["id"] for node in nodes_to_trans], nodes_trans))
+
+        for index, j_res_c in enumerate(j_res, offset):
+            c_id = j_res_c["id"]
+            c_author = j_res_c["author"]["login"]
+            c_replies = j_res_c["replies"]['totalCount']
+            c_url = j_res_c["url"]
+            c_body = j_res_c["body"]
+            print("")
+            print(f"===============Comment(#{index+1})===============")
+            print(f"ID: {c_id}")
+            print(f"Author: {c_author}")
+            print(f"Replies: {c_replies}")
+            print(f"URL: {c_url}")
+            print(f"Body:\n{c_body}\n")
+
+            print(f"Updating......")
+            if TRANS_MAGIC in c_body:
+                comment_trans_by_gpt = True
+                print(f"Already translated, skip")
+            elif c_id in skip:
+                print(f"Translated by the comment event, skip")
+            elif already_english(c_body):
+                print(f"Body is already english, skip")
+            else:
+                (c_body_trans, trans_by_gpt, real_translated) = nodes_trans[c_id]
+                comment_trans_by_gpt = comment_trans_by_gpt or trans_by_gpt
+                if real_translated:
+                    print(f"Body:\n{c_body_trans}\n")
+                    batch.add('updateDiscussionComment', c_id, wrap_magic(c_body_trans))
+                    print(f"Queued update")
+
+            for position, j_res_c_reply in enumerate(j_res_c["replies"]["nodes"]):
+                reply_id = j_res_c_reply["id"]
+                reply_author = j_res_c_reply["author"]["login"]
+                reply_url = j_res_c_reply["url"]
+                reply_body = j_res_c_reply["body"]
+                print(f"---------------Reply(#{position+1})---------------")
+                print(f"ID: {reply_id}")
+                print(f"Author: {reply_author}")
+                print(f"URL: {reply_url}")
+                print(f"Body:\n{reply_body}\n")
+
+                print(f"Updating......")
+                if TRANS_MAGIC in reply_body:
+                    comment_trans_by_gpt = True
+                    print(f"Already translated, skip")
+                elif reply_id in skip:
+                    print(f"Translated by the comment event, skip")
+                elif already_english(reply_body):
+                    print(f"Body is already english, skip")
+                else:
+                    (reply_body_trans, trans_by_gpt, real_translated) = nodes_trans[reply_id]
+                    comment_trans_by_gpt = comment_trans_by_gpt or trans_by_gpt
+                    if real_translated:
+                        print(f"Body:\n{reply_body_trans}\n")
+                        batch.add('updateDiscussionComment', reply_id, wrap_magic(reply_body_trans))
+                        print(f"Queued update")
+
+        flush_comment_updates(batch)
+        offset += len(j_res)
+
+    id = j_discussion_res["id"]
+    title = j_discussion_res["title"]
+    body = j_discussion_res["body"]
+
+    has_gpt_label = False
+    has_en_native_label = False
+    labels4print=[]
+    for label in j_discussion_res["labels"]:
+        if label["name"] == LABEL_TRANS_NAME:
+            has_gpt_label = True
+        if label["name"] == LABEL_ENGLISH_NATIVE:
+            has_en_native_label = True
+        labels4print.append(f"{label['id']}({label['name']})")
+    print("")
+    print(f"===============ISSUE===============")
+    print(f"ID: {id}")
+    print(f"Url: {url}")
+    print(f"Title: {title}")
+    print(f"Labels: {', '.join(labels4print)}")
+    print(f"Body:\n{body}\n")
+
+    print(f"Updating......")
+    issue_changed = False
+    issue_trans_by_gpt = False
+    title_trans = title
+    body_trans = body
+    if already_english(title):
+        print(f"Title is already english, skip")
+    else:
+        (title_trans, trans_by_gpt, real_translated) = gpt_translate(title, issue_trans_by_gpt)
+        if trans_by_gpt:
+            issue_trans_by_gpt = True
+        if real_translated:
+            issue_changed = True
+            print(f"Title: {title_trans}")
+
+    if TRANS_MAGIC in body:
+        issue_trans_by_gpt = True
+        print(f"Body is already translated, skip")
+    elif already_english(body):
+        print(f"Body is already english, skip")
+    else:
+        (body_trans, trans_by_gpt, real_translated) = gpt_translate(body, issue_trans_by_gpt)
+        if trans_by_gpt:
+            issue_trans_by_gpt = True
+        if real_translated:
+            issue_changed = True
+            print(f"Body:\n{body_trans}\n")
+
+    if not issue_changed:
+        print(f"Nothing changed, skip")
+    else:
+        update_discussion(id, title_trans, wrap_magic(body_trans))
+        print(f"Updated ok")
+
+    any_by_gpt = comment_trans_by_gpt or issue_trans_by_gpt
+    labels = []
+    if not any_by_gpt or has_gpt_label:
+        print(f"Label is already set, skip")
+    else:
+        labels.append(LABEL_TRANS_NAME)
+
+    if not any_by_gpt and not has_gpt_label and not has_en_native_label:
+        labels.append(LABEL_ENGLISH_NATIVE)
+
+    if len(labels) > 0:
+        print(f"Add labels {', '.join(labels)}")
+        label_ids = add_labels_by_name(discussion["owner"], discussion["name"], id, labels)
+        print(f"Add labels ok, {', '.join(label_ids)}")
+
+    return {
+        "id": id,
+        "title": title_trans,
+        "body": wrap_magic(body_trans) if issue_changed else body,
+        "changed": issue_changed,
+    }
+
+def trans_pullrequest(url, seed=None, skip=()):
+    """
+    Translate the title, body and comments of the PR by url, for example, https://github.com/ossrs/srs/pull/3699
+    then update them and add the labels. Return the translated title and body, and whether they are changed by
+    the translation, to forward the webhook event.
+    The seed is the PR built from webhook payload by parse_webhook_item, or None to query it.
+    The comments whose node id is in skip are left as is, because they're translated by their own events.
+    """
+    pr = parse_pullrequest_url(url)
+    if seed is not None:
+        print(f"Use the PR from webhook payload, skip query")
+        j_pr_res = seed
+    else:
+        j_pr_res = query_pullrequest_all_in_one(pr["owner"], pr["name"], pr["number"])
+
+    # Process the comments page by page, while the next page is fetching, so a long thread never loads at once.
+    comment_trans_by_gpt = False
+    batch = GraphQLMutationBatch()
+    offset = 0
+    for comments in iter_pages(j_pr_res['comments']):
+        comments_to_trans = [j_res_c for j_res_c in comments if j_res_c["id"] not in skip]
+        comments_trans = gpt_translate_many([j_res_c["body"] for j_res_c in comments_to_trans], False)
+        comments_trans = dict(zip([j_res_c["id"] for j_res_c in comments_to_trans], comments_trans))
+        for index, j_res_c in enumerate(comments, offset):
+            c_id = j_res_c["id"]
+            c_url = j_res_c["url"]
+            c_body = j_res_c["body"]
+            print("")
+            print(f"===============Comment(#{index+1})===============")
+            print(f"ID: {c_id}")
+            print(f"URL: {c_url}")
+            print(f"Body:\n{c_body}\n")
+
+            if c_id in skip:
+                print(f"Translated by the comment event, skip")
+                continue
+
+            print(f"Updating......")
+            (c_body_trans, trans_by_gpt, real_translated) = comments_trans[c_id]
+            comment_trans_by_gpt = comment_trans_by_gpt or trans_by_gpt
+            if real_translated:
+                print(f"Body:\n{c_body_trans}\n")
+                batch.add('updateIssueComment', c_id, wrap_magic(c_body_trans))
+                print(f"Queued update")
+
+        flush_comment_updates(batch)
+        offset += len(comments)
+
+    # Process the reviews page by page too, with all comments of each review.
+    offset = 0
+    for j_reviews_res in iter_pages(j_pr_res['reviews']):
+        # Translate the reviews and review comments of a page together, so the short ones can be packed into one request.
+        nodes_to_trans = []
+        for j_res_c in j_reviews_res:
+            for node in [j_res_c] + j_res_c["comments"]["nodes"]:
+                if node["id"] not in skip and TRANS_MAGIC not in node["body"] and not already_english(node["body"]):
+                    nodes_to_trans.append(node)
+        nodes_trans = gpt_translate_many([node["body"] for node in nodes_to_trans], False)
+        nodes_trans = dict(zip([node["id"] for node in nodes_to_trans], nodes_trans))
+
+        for index, j_res_c in enumerate(j_reviews_res, offset):
+            c_id = j_res_c["id"]
+            c_comments = j_res_c["comments"]['totalCount']
+            c_url = j_res_c["url"]
+            c_body = j_res_c["body"]
+            print("")
+            print(f"===============Review(#{index+1})===============")
+            print(f"ID: {c_id}")
+            print(f"Comments: {c_comments}")
+            print(f"URL: {c_url}")
+            print(f"Body:\n{c_body}\n")
+
+            print(f"Updating......")
+            if TRANS_MAGIC in c_body:
+                comment_trans_by_gpt = True
+                print(f"Already translated, skip")
+            elif c_id in skip:
+                print(f"Translated by the comment event, skip")
+            elif already_english(c_body):
+                print(f"Body is already english, skip")
+            else:
+                (c_body_trans, trans_by_gpt, real_translated) = nodes_trans[c_id]
+                comment_trans_by_gpt = comment_trans_by_gpt or trans_by_gpt
+                if real_translated:
+                    print(f"Body:\n{c_body_trans}\n")
+                    batch.add('updatePullRequestReview', c_id, wrap_magic(c_body_trans))
+                    print(f"Queued update")
+
+            for position, j_res_c_reply in enumerate(j_res_c["comments"]["nodes"]):
+                reply_id = j_res_c_reply["id"]
+                reply_url = j_res_c_reply["url"]
+                reply_body = j_res_c_reply["body"]
+                print(f"---------------ReviewComment(#{position+1})---------------")
+                print(f"ID: {reply_id}")
+                print(f"URL: {reply_url}")
+                print(f"Body:\n{reply_body}\n")
+
+                print(f"Updating......")
+                if TRANS_MAGIC in reply_body:
+                    comment_trans_by_gpt = True
+                    print(f"Already translated, skip")
+                elif reply_id in skip:
+                    print(f"Translated by the comment event, skip")
+                elif already_english(reply_body):
+                    print(f"Body is already english, skip")
+                else:
+                    (reply_body_trans, trans_by_gpt, real_translated) = nodes_trans[reply_id]
+                    comment_trans_by_gpt = comment_trans_by_gpt or trans_by_gpt
+                    if real_translated:
+                        print(f"Body:\n{reply_body_trans}\n")
+                        batch.add('updatePullRequestReviewComment', reply_id, wrap_magic(reply_body_trans))
+                        print(f"Queued update")
+
+        flush_comment_updates(batch)
+        offset += len(j_reviews_res)
+
+    id = j_pr_res["id"]
+    title = j_pr_res["title"]
+    body = j_pr_res["body"]
+
+    has_gpt_label = False
+    has_en_native_label = False
+    labels4print=[]
+    for label in j_pr_res["labels"]:
+        if label["name"] == LABEL_TRANS_NAME:
+            has_gpt_label = True
+        if label["name"] == LABEL_ENGLISH_NATIVE:
+            has_en_native_label = True
+        labels4print.append(f"{label['id']}({label['name']})")
+    print("")
+    print(f"===============PullRequest===============")
+    print(f"ID: {id}")
+    print(f"Url: {url}")
+    print(f"Title: {title}")
+    print(f"Labels: {', '.join(labels4print)}")
+    print(f"Body:\n{body}\n")
+
+    print(f"Updating......")
+    issue_changed = False
+    issue_trans_by_gpt = False
+    title_trans = title
+    body_trans = body
+    if already_english(title):
+        print(f"Title is already english, skip")
+    else:
+        (title_trans, trans_by_gpt, real_translated) = gpt_translate(title, issue_trans_by_gpt)
+        if trans_by_gpt:
+            issue_trans_by_gpt = True
+        if real_translated:
+            issue_changed = True
+            print(f"Title: {title_trans}")
+
+    if TRANS_MAGIC in body:
+        issue_trans_by_gpt = True
+        print(f"Body is already translated, skip")
+    elif already_english(body):
+        print(f"Body is already english, skip")
+    else:
+        (body_trans, trans_by_gpt, real_translated) = gpt_translate(body, issue_trans_by_gpt)
+        if trans_by_gpt:
+            issue_trans_by_gpt = True
+        if real_translated:
+            issue_changed = True
+            print(f"Body:\n{body_trans}\n")
+
+    if not issue_changed:
+        print(f"Nothing changed, skip")
+    else:
+        update_pullrequest(id, title_trans, wrap_magic(body_trans, TRANS_DELIMETER_PR))
+        print(f"Updated ok")
+
+    any_by_gpt = comment_trans_by_gpt or issue_trans_by_gpt
+    labels = []
+    if not any_by_gpt or has_gpt_label:
+        print(f"Label is already set, skip")
+    else:
+        labels.append(LABEL_TRANS_NAME)
+
+    if not any_by_gpt and not has_gpt_label and not has_en_native_label:
+        labels.append(LABEL_ENGLISH_NATIVE)
+
+    if len(labels) > 0:
+        print(f"Add labels {', '.join(labels)}")
+        label_ids = add_labels_by_name(pr["owner"], pr["name"], id, labels)
+        print(f"Add labels ok, {', '.join(label_ids)}")
+
+    return {
+        "id": id,
+        "title": title_trans,
+        "body": wrap_magic(body_trans, TRANS_DELIMETER_PR) if issue_changed else body,
+        "changed": issue_changed,
+    }
+
+def flush_comment_updates(batch, on_error=None):
+    """
+    Send the comment updates in a few aliased mutation documents, instead of one request for each. The failed
+    mutation is raised, or passed to on_error(mutation) to handle the others, see server.py.
+    """
+    for mutation in batch.flush():
+        if mutation.error is None:
+            print(f"Updated ok, {mutation.operation} {mutation.id}")
+        elif mutation.error.is_forbidden():
+            print(f"Warning!!! Ignore update comment {mutation.id} failed, forbidden, {mutation.error.errors}")
+        elif on_error is not None:
+            on_error(mutation)
+        else:
+            raise mutation.error